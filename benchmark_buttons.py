@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-recipient button building, old scan vs. cached campaign buttons
+"""
+import os
+import sys
+import time
+import asyncio
+import tracemalloc
+import urllib.parse
+
+# bot.py exits without a token; the benchmark never connects to Discord
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'benchmark')
+
+from bot import CampaignButtons, create_button_view
+
+API_BASE_URL = 'https://base44.app/api/apps/benchmark/functions'
+
+CONFIG = {
+    'affiliate_id': 'aff123',
+    'affiliate_links': [
+        {'name': f'link_{i}', 'url_template': f'https://example.com/offer/{i}?ref=discord', 'enabled': True}
+        for i in range(20)
+    ] + [{'name': 'main_affiliate_link', 'url_template': 'https://example.com/affiliate?ref=discord'}]
+}
+
+TEMPLATE = {
+    'name': 'welcome_message',
+    'has_buttons': True,
+    'button_labels': ['Get Started', 'Learn More'],
+    'selected_link_name': 'main_affiliate_link'
+}
+
+def legacy_view(template, config):
+    """The per-recipient button path used before links were indexed"""
+    buttons = []
+    for label in template.get('button_labels', []):
+        link_name = template.get('selected_link_name', 'main_affiliate_link')
+        original_url = next(
+            (link['url_template'] for link in config.get('affiliate_links', [])
+             if link['name'] == link_name),
+            '#'
+        )
+        tracking_code = f"{config.get('affiliate_id', 'default')}_{template['name']}_{int(time.time())}"
+        encoded_url = urllib.parse.quote(original_url)
+        trackable_url = f'{API_BASE_URL}/functions/trackLinkClick?code={tracking_code}&redirect={encoded_url}'
+        buttons.append({'label': label, 'url': trackable_url, 'style': 'primary'})
+    return create_button_view(buttons)
+
+def measure(name, func, count):
+    """Time func over count recipients, then count what each call leaves allocated"""
+    started = time.perf_counter()
+    for _ in range(count):
+        func()
+    elapsed = time.perf_counter() - started
+
+    # Keep every result alive, as the send path does until the DM is posted
+    results = []
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for _ in range(count):
+        results.append(func())
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"   {name}: {elapsed * 1e6 / count:.2f} µs/recipient, "
+          f"{(after - before) / count:.1f} bytes retained/recipient")
+    return elapsed
+
+async def main():
+    """Compare both paths for the same template and config"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    campaign_buttons = CampaignButtons(
+        API_BASE_URL, TEMPLATE, CONFIG['affiliate_id'], CONFIG['affiliate_links'][-1]['url_template'])
+
+    print(f"🚀 Building buttons for {count} recipients")
+    print("=" * 50)
+    legacy_time = measure('Scan + new view', lambda: legacy_view(TEMPLATE, CONFIG), count)
+    cached_time = measure('Cached view    ', campaign_buttons.view, count)
+    print(f"   Speedup: {legacy_time / cached_time:.1f}x")
+
+if __name__ == '__main__':
+    asyncio.run(main())
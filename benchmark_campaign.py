@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Synthetic-load benchmark for the campaign pipeline
+
+Builds fake guilds with a configurable number of members and role
+distribution, then drives AffiliateBot.get_users_by_roles and
+AffiliateBot.process_campaign against them. Members' send() simulates
+Discord latency and 429 retries, and Base44 calls are answered in-process,
+so nothing leaves the machine.
+
+Usage: python benchmark_campaign.py --members 100000 --output results.json
+"""
+import os
+import sys
+import json
+import logging
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from types import SimpleNamespace
+
+def parse_args():
+    """Command line options for the benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmark the campaign pipeline against fake guilds')
+    parser.add_argument('--members', type=int, default=10000, help='members per guild (10k to 1M)')
+    parser.add_argument('--guilds', type=int, default=1, help='number of guilds')
+    parser.add_argument('--roles', type=int, default=20, help='roles per guild')
+    parser.add_argument('--target-roles', type=int, default=2, help='how many roles the campaign targets')
+    parser.add_argument('--role-density', type=float, default=0.05,
+                        help='chance a member has a given role (uniform) or the most common role (zipf)')
+    parser.add_argument('--distribution', choices=['uniform', 'zipf'], default='uniform',
+                        help='how roles are spread over members')
+    parser.add_argument('--overlap', type=float, default=0.0,
+                        help='share of members that also appear in every other guild')
+    parser.add_argument('--send-latency', type=float, default=0.05, help='mean simulated DM latency in seconds')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.01, help='share of sends that hit a 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='simulated 429 retry_after in seconds')
+    parser.add_argument('--forbidden-rate', type=float, default=0.02, help='share of users with DMs disabled')
+    parser.add_argument('--concurrency', type=int, default=None, help='campaign workers (default: CAMPAIGN_CONCURRENCY)')
+    parser.add_argument('--global-rate', type=float, default=0, help='DMs per second across all users (0 = unlimited)')
+    parser.add_argument('--skip-campaign', action='store_true', help='only benchmark audience building')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help='write results to this JSON file')
+    return parser.parse_args()
+
+# bot.py reads its settings at import, so point everything at throwaway files first
+ARGS = parse_args() if __name__ == '__main__' else None
+WORK_DIR = tempfile.TemporaryDirectory(prefix='affiliate-bench-')
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'benchmark')
+os.environ['DELIVERY_LEDGER_PATH'] = os.path.join(WORK_DIR.name, 'ledger.db')
+os.environ['CONFIG_CACHE_PATH'] = os.path.join(WORK_DIR.name, 'config.json')
+os.environ['BASE44_SPOOL_PATH'] = os.path.join(WORK_DIR.name, 'spool.db')
+os.environ['METRICS_PORT'] = '0'
+# Only warnings and errors; the logging pipeline itself stays in the measured path
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import discord
+import bot
+
+class FakeRole:
+    __slots__ = ('id', 'name', 'guild')
+
+    def __init__(self, role_id, name, guild):
+        self.id = role_id
+        self.name = name
+        self.guild = guild
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+class FakeMember:
+    """Stand-in for discord.Member whose send() behaves like a Discord DM"""
+    __slots__ = ('id', 'guild', 'roles', 'name', 'display_name', 'mention', 'dms_disabled', 'network')
+
+    def __init__(self, member_id, guild, roles, dms_disabled, network):
+        self.id = member_id
+        self.guild = guild
+        self.roles = roles
+        self.name = f'user{member_id}'
+        self.display_name = f'User {member_id}'
+        self.mention = f'<@{member_id}>'
+        self.dms_disabled = dms_disabled
+        self.network = network
+
+    async def send(self, content=None, view=None):
+        await self.network.request()
+        if self.dms_disabled:
+            response = SimpleNamespace(status=403, reason='Forbidden')
+            raise discord.Forbidden(response, 'Cannot send messages to this user')
+
+class FakeNetwork:
+    """Simulated Discord latency; a 429 costs its retry_after plus a second attempt,
+    which is how discord.py's HTTP client handles it internally, and logs the same
+    warning discord.py does so the adaptive rate controller sees it"""
+
+    def __init__(self, latency, rate_limit_rate, retry_after, rng):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.rng = rng
+        self.requests = 0
+        self.rate_limited = 0
+        self.http_log = logging.getLogger('discord.http')
+
+    async def request(self):
+        self.requests += 1
+        delay = self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0
+        if self.rng.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            self.http_log.warning('We are being rate limited. %s %s responded with 429. Retrying in %.2f seconds.',
+                                  'POST', '/users/@me/channels', self.retry_after)
+            delay += self.retry_after + self.latency
+        await asyncio.sleep(delay)
+
+class FakeGuild:
+    def __init__(self, guild_id, roles):
+        self.id = guild_id
+        self.name = f'Guild {guild_id}'
+        self.roles = [FakeRole(guild_id * 1000 + i, f'role{i}', self) for i in range(roles)]
+        self._members = {}
+        self.chunked = True
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    @property
+    def member_count(self):
+        return len(self._members)
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+def build_guilds(args, network, rng):
+    """Create guilds and members with the requested role distribution"""
+    guilds = [FakeGuild(guild_id + 1, args.roles) for guild_id in range(args.guilds)]
+    shared = int(args.members * args.overlap)
+    if args.distribution == 'zipf':
+        weights = [args.role_density / (rank + 1) for rank in range(args.roles)]
+    else:
+        weights = [args.role_density] * args.roles
+    for guild_index, guild in enumerate(guilds):
+        for i in range(args.members):
+            # The first `shared` member IDs are the same people in every guild
+            member_id = 10**12 + i if i < shared else 10**12 + (guild_index + 1) * 10**7 + i
+            roles = [role for role, weight in zip(guild.roles, weights) if rng.random() < weight]
+            guild._members[member_id] = FakeMember(member_id, guild, roles, rng.random() < args.forbidden_rate, network)
+    return guilds
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+class LoopLagMonitor:
+    """Measures how late a 10ms timer fires, i.e. how long the loop was blocked"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+        return {
+            'p50_ms': round(percentile(self.lags, 50) * 1000, 2),
+            'p99_ms': round(percentile(self.lags, 99) * 1000, 2),
+            'max_ms': round(max(self.lags, default=0.0) * 1000, 2)
+        }
+
+def git_revision():
+    """Short commit hash of the benchmarked tree, if available"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+async def run_benchmark(args):
+    """Build the fake world, then time audience building and a full campaign"""
+    rng = random.Random(args.seed)
+    network = FakeNetwork(args.send_latency, args.rate_limit_rate, args.retry_after, rng)
+    affiliate_bot = bot.affiliate_bot
+
+    async def base44_stub(function_name, payload=None):
+        return {'success': True}
+    affiliate_bot.base44_client.call_function = base44_stub
+
+    started = time.perf_counter()
+    guilds = build_guilds(args, network, rng)
+    build_seconds = time.perf_counter() - started
+    # process_campaign walks discord_bot.guilds; the harness never connects
+    bot.discord_bot = SimpleNamespace(guilds=guilds, shard_count=None)
+
+    target_roles = [
+        {'role_id': str(role.id), 'role_name': role.name, 'enabled': True}
+        for guild in guilds for role in guild.roles[:args.target_roles]
+    ]
+    config = affiliate_bot.apply_config({
+        'active': True,
+        'affiliate_id': 'benchmark',
+        'message_templates': [{
+            'name': 'benchmark_campaign',
+            'content': 'Hey {username}, welcome to {server_name}! Use code {affiliate_id}.',
+            'has_buttons': False
+        }],
+        'target_roles': target_roles,
+        'affiliate_links': [],
+        'settings': {'rate_limit_delay': 0, 'max_dms_per_hour': 0, 'global_dm_rate': args.global_rate}
+    }, persist=False)
+    if args.concurrency:
+        affiliate_bot.dispatcher.concurrency = args.concurrency
+
+    results = {'build_seconds': round(build_seconds, 2)}
+
+    started = time.perf_counter()
+    affiliate_bot.build_role_index(guilds)
+    results['index_seconds'] = round(time.perf_counter() - started, 3)
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    audience_times = []
+    for _ in range(5):
+        started = time.perf_counter()
+        audience = 0
+        for guild in guilds:
+            audience += len(await affiliate_bot.get_users_by_roles(guild, config['target_roles']))
+        audience_times.append(time.perf_counter() - started)
+    results['audience'] = {
+        'users': audience,
+        'p50_seconds': round(percentile(audience_times, 50), 4),
+        'max_seconds': round(max(audience_times), 4)
+    }
+
+    if not args.skip_campaign:
+        send_latencies = []
+        send_dm_safely = affiliate_bot.rate_limiter.send_dm_safely
+
+        async def timed_send(user, content, buttons=None, view=None):
+            sent_at = time.perf_counter()
+            try:
+                return await send_dm_safely(user, content, buttons, view=view)
+            finally:
+                send_latencies.append(time.perf_counter() - sent_at)
+        affiliate_bot.rate_limiter.send_dm_safely = timed_send
+
+        started = time.perf_counter()
+        stats = await affiliate_bot.process_campaign(config['message_templates'][0], config)
+        await affiliate_bot.activity_shipper.close()
+        elapsed = time.perf_counter() - started
+        results['campaign'] = {
+            'recipients': len(send_latencies),
+            'sent': stats['sent'],
+            'failed': stats['failed'],
+            'concurrency': affiliate_bot.dispatcher.concurrency,
+            'seconds': round(elapsed, 2),
+            'users_per_second': round(len(send_latencies) / elapsed, 1) if elapsed else 0.0,
+            'send_p50_ms': round(percentile(send_latencies, 50) * 1000, 1),
+            'send_p99_ms': round(percentile(send_latencies, 99) * 1000, 1),
+            'simulated_429s': network.rate_limited,
+            'controller_429s': bot.DISCORD_RATE_LIMITS_TOTAL.total(),
+            'activity_batches': affiliate_bot.activity_shipper.batches
+        }
+
+    results['event_loop_lag'] = await monitor.stop()
+    results['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    await affiliate_bot.delivery_ledger.close()
+    return results
+
+def main():
+    """Run the benchmark and print or save the results"""
+    args = ARGS
+    print(f"🚀 Campaign benchmark: {args.guilds} guild(s) x {args.members} members, "
+          f"{args.roles} roles ({args.distribution}), targeting {args.target_roles}")
+    print("=" * 60)
+    try:
+        results = asyncio.run(run_benchmark(args))
+    finally:
+        WORK_DIR.cleanup()
+
+    audience = results['audience']
+    print(f"   Role index build: {results['index_seconds']}s")
+    print(f"   Audience: {audience['users']} users, p50 {audience['p50_seconds']}s per build")
+    if 'campaign' in results:
+        campaign = results['campaign']
+        print(f"   Campaign: {campaign['recipients']} recipients in {campaign['seconds']}s "
+              f"({campaign['users_per_second']} users/s, concurrency {campaign['concurrency']})")
+        print(f"   Send latency: p50 {campaign['send_p50_ms']}ms, p99 {campaign['send_p99_ms']}ms "
+              f"({campaign['simulated_429s']} simulated 429s, {campaign['controller_429s']} seen by the controller)")
+    lag = results['event_loop_lag']
+    print(f"   Event loop lag: p50 {lag['p50_ms']}ms, p99 {lag['p99_ms']}ms, max {lag['max_ms']}ms")
+    print(f"   Peak RSS: {results['peak_rss_mb']} MB")
+
+    if args.output:
+        report = {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': sys.version.split()[0],
+            'parameters': vars(args),
+            'results': results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✅ Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: resident memory of the full vs. lean gateway setup
+
+Connects to Discord with the bot's real token once per mode, each in a fresh
+process, and reports resident memory after startup and after every guild's
+members are loaded, normalised to MB per 100k members.
+
+Usage: python benchmark_memory.py [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+from dotenv import load_dotenv
+
+def rss_mb():
+    """Current resident set size of this process in MB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    # ru_maxrss is the peak, in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def measure_mode(mode):
+    """Child process: connect in one mode, load all members, print JSON stats"""
+    import discord
+    from bot import gateway_options
+
+    baseline = rss_mb()
+    client = discord.Client(**gateway_options(mode == 'lean'))
+    result = {'mode': mode, 'baseline_mb': round(baseline, 1)}
+
+    @client.event
+    async def on_ready():
+        result['ready_mb'] = round(rss_mb(), 1)
+        result['ready_members'] = sum(len(guild.members) for guild in client.guilds)
+        started = time.perf_counter()
+        for guild in client.guilds:
+            if not guild.chunked:
+                await guild.chunk(cache=True)
+        result['chunk_seconds'] = round(time.perf_counter() - started, 1)
+        # Let the gateway settle so event caches (presences, messages) fill up
+        await asyncio.sleep(30)
+        result['guilds'] = len(client.guilds)
+        result['members'] = sum(len(guild.members) for guild in client.guilds)
+        result['loaded_mb'] = round(rss_mb(), 1)
+        members = max(result['members'], 1)
+        result['mb_per_100k_members'] = round((result['loaded_mb'] - baseline) * 100000 / members, 1)
+        await client.close()
+
+    client.run(os.getenv('DISCORD_BOT_TOKEN'), log_handler=None)
+    print(json.dumps(result))
+
+def main():
+    """Run each mode in its own process and compare"""
+    parser = argparse.ArgumentParser(description='Compare bot memory use with and without LEAN_GATEWAY')
+    parser.add_argument('--mode', choices=['full', 'lean'], help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    load_dotenv()
+    if not os.getenv('DISCORD_BOT_TOKEN'):
+        print("❌ DISCORD_BOT_TOKEN environment variable is required!")
+        sys.exit(1)
+
+    if args.mode:
+        measure_mode(args.mode)
+        return
+
+    print("🔍 Measuring gateway memory use (one connection per mode)...")
+    print("=" * 60)
+    results = []
+    for mode in ('full', 'lean'):
+        output = subprocess.run([sys.executable, __file__, '--mode', mode],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"   {mode:>4}: {result['members']} members in {result['guilds']} guild(s)")
+        print(f"         startup {result['ready_mb']} MB, after loading members {result['loaded_mb']} MB")
+        print(f"         {result['mb_per_100k_members']} MB per 100k members")
+
+    full, lean = results
+    if full['mb_per_100k_members']:
+        saved = 100 * (1 - lean['mb_per_100k_members'] / full['mb_per_100k_members'])
+        print(f"\n✅ Lean mode uses {saved:.0f}% less memory per member")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"   Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: precompiled template engine vs. the old str.replace renderer
+"""
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+# bot.py exits without a token; the benchmark never connects to Discord
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'benchmark')
+
+from bot import TemplateEngine
+
+TEMPLATE = (
+    "Welcome {username}! Thanks for joining {server_name}! 🎉\n\n"
+    "Hey {user_mention}, your partner code is {affiliate_id}.\n"
+    "Check out our latest offers below - they are picked just for {username}."
+)
+
+def legacy_process_message_template(template, user, affiliate_id):
+    """The renderer used before templates were precompiled"""
+    content = template['content']
+    content = content.replace('{username}', user.display_name)
+    content = content.replace('{user_mention}', user.mention)
+    content = content.replace('{affiliate_id}', str(affiliate_id))
+    content = content.replace('{server_name}', user.guild.name if user.guild else 'Unknown Server')
+    return content
+
+def make_users(count):
+    """Build lightweight stand-ins for discord.Member"""
+    guild = SimpleNamespace(id=1, name='Benchmark Server')
+    return [
+        SimpleNamespace(id=i, name=f'user{i}', display_name=f'User {i}', mention=f'<@{i}>', guild=guild)
+        for i in range(count)
+    ]
+
+def main():
+    """Run both renderers over the same users and compare"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = 5
+    users = make_users(count)
+    template = {'name': 'welcome_message', 'content': TEMPLATE}
+    engine = TemplateEngine()
+
+    for user in users[:100]:
+        legacy = legacy_process_message_template(template, user, 'aff123')
+        compiled = engine.render(template['content'], user, 'aff123', template['name'])
+        assert legacy == compiled, 'renderers disagree'
+
+    def run_legacy():
+        for user in users:
+            legacy_process_message_template(template, user, 'aff123')
+
+    def run_compiled():
+        for user in users:
+            engine.render(template['content'], user, 'aff123', template['name'])
+
+    def run_bound():
+        bound = engine.bind(template['content'], users[0].guild, 'aff123', template['name'])
+        for user in users:
+            bound.render(user)
+
+    print(f"🚀 Rendering {count} messages, best of {repeat}")
+    print("=" * 50)
+    legacy_time = min(timeit.repeat(run_legacy, number=1, repeat=repeat))
+    compiled_time = min(timeit.repeat(run_compiled, number=1, repeat=repeat))
+    bound_time = min(timeit.repeat(run_bound, number=1, repeat=repeat))
+    print(f"   str.replace renderer:      {legacy_time * 1e6 / count:.2f} µs/message")
+    print(f"   Compiled, cache lookup:    {compiled_time * 1e6 / count:.2f} µs/message "
+          f"({legacy_time / compiled_time:.2f}x)")
+    print(f"   Compiled, pre-bound guild: {bound_time * 1e6 / count:.2f} µs/message "
+          f"({legacy_time / bound_time:.2f}x)")
+
+if __name__ == '__main__':
+    main()
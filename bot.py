@@ -5,43 +5,528 @@ import asyncio
 import aiohttp
 import os
 import time
+import random
 import urllib.parse
-from datetime import datetime
+import hashlib
+import json
+import re
+import sqlite3
+import uuid
+import sys
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from aiohttp import web
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 load_dotenv()
 
 DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 BOT_ID = os.getenv('BASE44_APP_ID', '68d1f85a602cecfca6c02c10')
 API_BASE_URL = os.getenv('API_BASE_URL', 'https://base44.app/api/apps/68d1f85a602cecfca6c02c10/functions')
+ACTIVITY_BATCH_SIZE = int(os.getenv('ACTIVITY_BATCH_SIZE', '50'))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '2.0'))
+ACTIVITY_QUEUE_SIZE = int(os.getenv('ACTIVITY_QUEUE_SIZE', '10000'))
+CAMPAIGN_CONCURRENCY = int(os.getenv('CAMPAIGN_CONCURRENCY', '8'))
+DM_GLOBAL_RATE = float(os.getenv('DM_GLOBAL_RATE', '20'))
+DM_USER_CACHE_SIZE = int(os.getenv('DM_USER_CACHE_SIZE', '100000'))
+ADAPTIVE_RATE = os.getenv('ADAPTIVE_RATE', 'true').lower() in ('1', 'true', 'yes')
+ADAPTIVE_MIN_RATE = float(os.getenv('ADAPTIVE_MIN_RATE', '1'))
+ADAPTIVE_LATENCY_TARGET = float(os.getenv('ADAPTIVE_LATENCY_TARGET', '1.0'))
+ADAPTIVE_WINDOW = float(os.getenv('ADAPTIVE_WINDOW', '5'))
+CAMPAIGN_MAX_CONCURRENCY = int(os.getenv('CAMPAIGN_MAX_CONCURRENCY', '64'))
+DM_PREWARM_LIMIT = int(os.getenv('DM_PREWARM_LIMIT', '0'))
+DM_PREWARM_CONCURRENCY = int(os.getenv('DM_PREWARM_CONCURRENCY', '4'))
+DELIVERY_LEDGER_PATH = os.getenv('DELIVERY_LEDGER_PATH', 'delivery_ledger.db')
+DELIVERY_RESEND_HOURS = float(os.getenv('DELIVERY_RESEND_HOURS', '0'))
+CAMPAIGN_CHECKPOINT_EVERY = int(os.getenv('CAMPAIGN_CHECKPOINT_EVERY', '100'))
+UNDELIVERABLE_TTL_HOURS = float(os.getenv('UNDELIVERABLE_TTL_HOURS', '168'))
+REALTIME_WORKERS = int(os.getenv('REALTIME_WORKERS', '2'))
+CONFIG_REFRESH_INTERVAL = float(os.getenv('CONFIG_REFRESH_INTERVAL', '300'))
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', '3600'))
+AUDIENCE_CACHE_TTL = float(os.getenv('AUDIENCE_CACHE_TTL', '60'))
+SCHEDULER_JITTER = float(os.getenv('SCHEDULER_JITTER', '0.1'))
+SCHEDULER_MAX_CONCURRENT = int(os.getenv('SCHEDULER_MAX_CONCURRENT', '2'))
+SCHEDULER_MAX_BACKOFF = float(os.getenv('SCHEDULER_MAX_BACKOFF', '4'))
+SCHEDULER_MIN_INTERVAL = float(os.getenv('SCHEDULER_MIN_INTERVAL', '60'))
+BASE44_TIMEOUT = float(os.getenv('BASE44_TIMEOUT', '10'))
+BASE44_MAX_RETRIES = int(os.getenv('BASE44_MAX_RETRIES', '3'))
+BASE44_BACKOFF_BASE = float(os.getenv('BASE44_BACKOFF_BASE', '0.5'))
+BASE44_BACKOFF_MAX = float(os.getenv('BASE44_BACKOFF_MAX', '10'))
+BASE44_BREAKER_THRESHOLD = int(os.getenv('BASE44_BREAKER_THRESHOLD', '5'))
+BASE44_BREAKER_COOLDOWN = float(os.getenv('BASE44_BREAKER_COOLDOWN', '30'))
+BASE44_POOL_SIZE = int(os.getenv('BASE44_POOL_SIZE', '20'))
+BASE44_SPOOL_PATH = os.getenv('BASE44_SPOOL_PATH', 'base44_spool.db')
+BASE44_SPOOL_MAX_ROWS = int(os.getenv('BASE44_SPOOL_MAX_ROWS', '100000'))
+BASE44_SPOOL_REPLAY_INTERVAL = float(os.getenv('BASE44_SPOOL_REPLAY_INTERVAL', '15'))
+BASE44_SPOOL_MAX_ATTEMPTS = int(os.getenv('BASE44_SPOOL_MAX_ATTEMPTS', '100'))
+STATS_BUCKET_SECONDS = float(os.getenv('STATS_BUCKET_SECONDS', '10'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+CONFIG_CACHE_PATH = os.getenv('CONFIG_CACHE_PATH', 'bot_config_cache.json')
+CONFIG_SECTIONS = ('message_templates', 'target_roles', 'affiliate_links', 'settings')
+AUTO_SHARD = os.getenv('AUTO_SHARD', '').lower() in ('1', 'true', 'yes')
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+WORKER_ID = os.getenv('WORKER_ID')
+# Set by launch_shards.py; Discord's global limit is per token, so workers split it
+WORKER_COUNT = max(1, int(os.getenv('SHARD_WORKERS') or 1)) if WORKER_ID is not None else 1
+LEAN_GATEWAY = os.getenv('LEAN_GATEWAY', '').lower() in ('1', 'true', 'yes')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'dm_sent=0.01')
+
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        # Anything passed through extra= becomes a top-level field
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        # event -> keep one record in every N
+        self.every = {event: max(1, round(1 / rate)) for event, rate in rates.items() if 0 < rate < 1}
+        self.dropped = {event: 0 for event, rate in rates.items() if rate <= 0}
+        self.counts = {}
+    
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event in self.dropped:
+            self.dropped[event] += 1
+            return False
+        every = self.every.get(event)
+        if every is None:
+            return True
+        count = self.counts.get(event, 0)
+        self.counts[event] = count + 1
+        if count % every:
+            return False
+        record.sample_every = every
+        return True
+
+def parse_sample_rates(value):
+    rates = {}
+    for item in value.split(','):
+        event, _, rate = item.partition('=')
+        if event.strip() and rate.strip():
+            rates[event.strip()] = float(rate)
+    return rates
+
+class LogQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        # Formatting happens on the listener thread, off the event loop
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT, sample_rates=LOG_SAMPLE_RATES):
+    logger = logging.getLogger('affiliate_bot')
+    if logger.handlers:
+        return logger
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(' %(message)s'))
+    handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(SamplingFilter(parse_sample_rates(sample_rates)))
+    listener = QueueListener(handler.queue, stream, respect_handler_level=True)
+    listener.start()
+    # Stopping the listener drains whatever is still queued
+    atexit.register(listener.stop)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    # discord.py's own warnings (gateway, rate limits) go through the same pipeline
+    discord_logger = logging.getLogger('discord')
+    if not discord_logger.handlers:
+        discord_logger.addHandler(handler)
+        discord_logger.setLevel(logging.WARNING)
+    return logger
+
+log = setup_logging()
 
 if not DISCORD_BOT_TOKEN:
-    print(' Error: DISCORD_BOT_TOKEN environment variable is required!')
+    log.error('Error: DISCORD_BOT_TOKEN environment variable is required!')
+    exit(1)
+
+if SHARD_IDS and not SHARD_COUNT:
+    log.error('Error: SHARD_COUNT is required when SHARD_IDS is set!')
     exit(1)
 
-intents = discord.Intents.all()
-discord_bot = commands.Bot(command_prefix='!', intents=intents)
+def gateway_options(lean):
+    if not lean:
+        return {'intents': discord.Intents.all()}
+    # The bot only reads guild roles and member roles/names and sends DMs, so
+    # presences, messages and voice state are never requested or cached, and
+    # guild members are chunked on demand instead of at startup.
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.members = True
+    return {
+        'intents': intents,
+        'member_cache_flags': discord.MemberCacheFlags.from_intents(intents),
+        'chunk_guilds_at_startup': False,
+        'max_messages': None
+    }
+
+if AUTO_SHARD or SHARD_COUNT or SHARD_IDS:
+    # Each process only connects the shards it owns, so discord_bot.guilds and
+    # every campaign it runs are limited to those shards' guilds.
+    discord_bot = commands.AutoShardedBot(command_prefix='!', shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+                                          **gateway_options(LEAN_GATEWAY))
+else:
+    discord_bot = commands.Bot(command_prefix='!', **gateway_options(LEAN_GATEWAY))
+
+def config_hash(value):
+    encoded = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+# Template fields that control when and to whom a campaign goes out, not what it says
+TEMPLATE_SCHEDULING_FIELDS = ('interval_minutes', 'priority', 'resend_after_hours', 'experiment_salt')
+
+def template_message_fields(template):
+    return {key: value for key, value in template.items() if key not in TEMPLATE_SCHEDULING_FIELDS}
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + '}'
+
+class Metric:
+    type = 'untyped'
+    
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return lines
+    
+    def samples(self):
+        return [f'{self.name}{_format_labels(labels)} {value}' for labels, value in self.values.items()]
+
+class Counter(Metric):
+    type = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+    
+    def total(self, **labels):
+        wanted = set(labels.items())
+        return sum(value for key, value in self.values.items() if wanted <= set(key))
+
+class Gauge(Metric):
+    type = 'gauge'
+    
+    def __init__(self, name, documentation, callback=None):
+        super().__init__(name, documentation)
+        self.callback = callback
+    
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+    
+    def samples(self):
+        if self.callback is not None:
+            try:
+                self.set(self.callback())
+            except Exception as e:
+                log.error('Error collecting metric %s: %s', self.name, e)
+        return super().samples()
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            # Per-bucket counts (last slot is +Inf), sum, count
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+    
+    def samples(self):
+        lines = []
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(labels, ("le", bound))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+    
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name, documentation):
+        return self._register(Counter(name, documentation))
+    
+    def gauge(self, name, documentation, callback=None):
+        return self._register(Gauge(name, documentation, callback))
+    
+    def histogram(self, name, documentation, buckets=Histogram.DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, buckets))
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+DM_SEND_SECONDS = metrics.histogram('affiliate_bot_dm_send_seconds', 'Latency of Discord DM sends')
+DMS_TOTAL = metrics.counter('affiliate_bot_dms_total', 'DMs attempted, by result')
+BASE44_CALL_SECONDS = metrics.histogram('affiliate_bot_base44_call_seconds', 'Latency of Base44 function calls')
+BASE44_ERRORS_TOTAL = metrics.counter('affiliate_bot_base44_errors_total', 'Failed Base44 call attempts')
+AUDIENCE_BUILD_SECONDS = metrics.histogram('affiliate_bot_audience_build_seconds', 'Time to build a campaign audience')
+TEMPLATE_RENDER_SECONDS = metrics.histogram('affiliate_bot_template_render_seconds', 'Time to render one message',
+                                            buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01))
+RATE_LIMIT_WAIT_SECONDS = metrics.histogram('affiliate_bot_rate_limit_wait_seconds', 'Time spent waiting on send rate limits')
+SEND_RATE = metrics.gauge('affiliate_bot_send_rate', 'DMs per second currently allowed by the adaptive controller')
+SEND_CONCURRENCY = metrics.gauge('affiliate_bot_send_concurrency', 'Campaign sends allowed in flight')
+RATE_DECISIONS_TOTAL = metrics.counter('affiliate_bot_rate_decisions_total', 'Adaptive rate controller decisions, by decision')
+DISCORD_RATE_LIMITS_TOTAL = metrics.counter('affiliate_bot_discord_rate_limits_total', '429 responses seen from Discord')
+SPOOL_REPLAYED_TOTAL = metrics.counter('affiliate_bot_spool_replayed_total', 'Spooled Base44 writes delivered on replay, by kind')
+SPOOL_DROPPED_TOTAL = metrics.counter('affiliate_bot_spool_dropped_total', 'Spooled Base44 writes dropped, by reason')
+UNDELIVERABLE_SKIPPED = metrics.counter('affiliate_bot_undeliverable_skipped_total', 'Sends skipped for users known to be undeliverable, by reason')
+CAMPAIGN_NEXT_RUN = metrics.gauge('affiliate_bot_campaign_next_run_timestamp', 'Unix time of the next scheduled run, by template')
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info('Metrics available at http://%s:%s/metrics', host, port)
+    return runner
+
+class CircuitBreaker:
+    def __init__(self, threshold=BASE44_BREAKER_THRESHOLD, cooldown=BASE44_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+    
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        # After the cooldown a single probe call is let through
+        if state == 'half_open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            if self.opened_at is None or self.probing:
+                self.trips += 1
+                log.warning('Base44 circuit breaker open for %ss after %s failures', self.cooldown, self.failures,
+                            extra={'event': 'breaker_open'})
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+def parse_retry_after(value):
+    # Retry-After is either delay-seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
 class Base44Client:
-    def __init__(self, api_base_url):
+    FUNCTION_TIMEOUTS = {
+        'getBotConfig': 15.0,
+        'logBotActivity': 10.0,
+        'updateBotStatus': 10.0
+    }
+    
+    def __init__(self, api_base_url, timeouts=None, max_retries=BASE44_MAX_RETRIES):
         self.api_base_url = api_base_url
         self.session = None
+        self.session_loop = None
+        self.timeouts = dict(self.FUNCTION_TIMEOUTS, **(timeouts or {}))
+        self.max_retries = max_retries
+        self.breaker = CircuitBreaker()
+        self.endpoint_stats = {}
+        # Cleared once logBotActivity turns out not to accept the batch body
+        self.batch_activities = True
+    
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=BASE44_POOL_SIZE,
+                limit_per_host=BASE44_POOL_SIZE,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.session_loop = loop
+        return self.session
+    
+    def _stats_for(self, function_name):
+        stats = self.endpoint_stats.get(function_name)
+        if stats is None:
+            stats = self.endpoint_stats[function_name] = {
+                'calls': 0, 'errors': 0, 'retries': 0, 'timeouts': 0,
+                'short_circuited': 0, 'latency_total': 0.0, 'latency_max': 0.0
+            }
+        return stats
+    
+    def stats(self):
+        endpoints = {}
+        for function_name, stats in self.endpoint_stats.items():
+            endpoints[function_name] = dict(stats,
+                latency_avg=round(stats['latency_total'] / stats['calls'], 4) if stats['calls'] else 0.0)
+        return {'breaker': self.breaker.state, 'breaker_trips': self.breaker.trips, 'endpoints': endpoints}
     
     async def call_function(self, function_name, payload=None):
-        try:
-            if not self.session:
-                self.session = aiohttp.ClientSession()
-            url = f'{self.api_base_url}/functions/{function_name}'
-            headers = {'Content-Type': 'application/json', 'User-Agent': 'DiscordBot/1.0'}
-            async with self.session.post(url, json=payload or {}, headers=headers) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    print(f' API call failed: {function_name} - Status: {response.status}')
-                    return None
-        except Exception as e:
-            print(f' Error calling {function_name}: {e}')
-            return None
+        stats = self._stats_for(function_name)
+        url = f'{self.api_base_url}/functions/{function_name}'
+        headers = {'Content-Type': 'application/json', 'User-Agent': 'DiscordBot/1.0'}
+        timeout = aiohttp.ClientTimeout(total=self.timeouts.get(function_name, BASE44_TIMEOUT))
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                stats['short_circuited'] += 1
+                return None
+            retryable = False
+            responded = None
+            retry_after = None
+            started = time.perf_counter()
+            try:
+                async with self._get_session().post(url, json=payload or {}, headers=headers, timeout=timeout) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        self._record_latency(stats, started, function_name)
+                        self.breaker.record_success()
+                        return result
+                    responded = response.status
+                    retryable = response.status >= 500 or response.status == 429
+                    if retryable:
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    log.warning('API call failed: %s - Status: %s', function_name, response.status,
+                                extra={'event': 'base44_error', 'function': function_name, 'status': response.status})
+            except asyncio.CancelledError:
+                # A cancelled half-open probe never reports back, so hand the
+                # probe to the next caller instead of staying half-open forever
+                self.breaker.probing = False
+                raise
+            except asyncio.TimeoutError:
+                retryable = True
+                stats['timeouts'] += 1
+                log.warning('Timeout calling %s', function_name, extra={'event': 'base44_error', 'function': function_name})
+            except aiohttp.ClientError as e:
+                retryable = True
+                log.warning('Error calling %s: %s', function_name, e, extra={'event': 'base44_error', 'function': function_name})
+            except Exception as e:
+                log.error('Error calling %s: %s', function_name, e, extra={'event': 'base44_error', 'function': function_name})
+            self._record_latency(stats, started, function_name)
+            stats['errors'] += 1
+            BASE44_ERRORS_TOTAL.inc(function=function_name)
+            if retryable:
+                self.breaker.record_failure()
+            elif responded:
+                # A 4xx still proves Base44 is reachable
+                self.breaker.record_success()
+            else:
+                self.breaker.probing = False
+            if not retryable:
+                # Base44 refused the call itself; callers can tell this apart
+                # from an outage (None) and must not expect a retry to succeed
+                return {'success': False, 'status': responded} if responded else None
+            if attempt == self.max_retries:
+                return None
+            stats['retries'] += 1
+            delay = random.uniform(0, min(BASE44_BACKOFF_MAX, BASE44_BACKOFF_BASE * 2 ** attempt))
+            # The server knows best when it will take requests again
+            await asyncio.sleep(max(delay, retry_after or 0))
+        return None
+    
+    @staticmethod
+    def _record_latency(stats, started, function_name):
+        latency = time.perf_counter() - started
+        BASE44_CALL_SECONDS.observe(latency, function=function_name)
+        stats['calls'] += 1
+        stats['latency_total'] += latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
     
     async def get_bot_config(self, bot_id, bot_token):
         payload = {'bot_id': bot_id, 'bot_token': bot_token}
@@ -50,39 +535,1798 @@ class Base44Client:
     async def log_bot_activity(self, activity_data):
         return await self.call_function('logBotActivity', activity_data)
     
+    async def log_bot_activity_batch(self, bot_id, activities):
+        if len(activities) == 1:
+            return await self.log_bot_activity(activities[0])
+        if self.batch_activities:
+            result = await self.call_function('logBotActivity', {'bot_id': bot_id, 'activities': activities})
+            if not result or result.get('success') or result.get('status') is None:
+                return result
+            log.warning('logBotActivity rejected a batch of %s (status %s), sending them one at a time',
+                        len(activities), result['status'])
+        # Older logBotActivity functions only take one activity per call
+        results = await asyncio.gather(*(self.log_bot_activity(activity) for activity in activities))
+        if any(result is None for result in results):
+            return None
+        logged = sum(1 for result in results if result.get('success'))
+        if self.batch_activities and logged == len(activities):
+            self.batch_activities = False
+            log.warning('logBotActivity does not accept batches, logging activities one at a time from now on')
+        if logged < len(activities):
+            log.warning('Base44 rejected %s of %s activities', len(activities) - logged, len(activities))
+        return {'success': True, 'logged': logged, 'rejected': len(activities) - logged}
+    
     async def update_bot_status(self, status_data):
         return await self.call_function('updateBotStatus', status_data)
     
     async def close(self):
         if self.session:
-            await self.session.close()
+            if self.session_loop is asyncio.get_running_loop():
+                await self.session.close()
+            self.session = None
+
+_SHIPPER_STOP = object()
+
+class ActivityShipper:
+    def __init__(self, base44_client, bot_id, batch_size=ACTIVITY_BATCH_SIZE,
+                 flush_interval=ACTIVITY_FLUSH_INTERVAL, max_queue_size=ACTIVITY_QUEUE_SIZE, spool=None):
+        self.base44_client = base44_client
+        self.bot_id = bot_id
+        # Batches Base44 does not accept are kept here and replayed later
+        self.spool = spool
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.queue = None
+        self.task = None
+        self.loop = None
+        self.closing = False
+        self.enqueued = 0
+        self.shipped = 0
+        self.failed = 0
+        self.dropped = 0
+        self.batches = 0
+    
+    def start(self):
+        # The queue is bound to the running loop, so it is created lazily and
+        # recreated if the shipper is used again from a fresh asyncio.run().
+        loop = asyncio.get_running_loop()
+        if self.task and not self.task.done() and self.loop is loop:
+            return
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.closing = False
+        self.task = loop.create_task(self._run())
+    
+    def enqueue(self, activity_data):
+        if self.closing and self.loop is asyncio.get_running_loop():
+            self.dropped += 1
+            return False
+        self.start()
+        try:
+            self.queue.put_nowait(activity_data)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+    
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'enqueued': self.enqueued,
+            'shipped': self.shipped,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'batches': self.batches
+        }
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            batch = []
+            if item is _SHIPPER_STOP:
+                stopping = True
+            else:
+                batch.append(item)
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if stopping or self.closing:
+                    if self.queue.empty():
+                        break
+                    item = self.queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _SHIPPER_STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+            if batch:
+                await self._ship(batch)
+            if self.closing and self.queue.empty():
+                stopping = True
+    
+    async def _ship(self, batch):
+        try:
+            result = await self.base44_client.log_bot_activity_batch(self.bot_id, batch)
+            self.batches += 1
+            if result and result.get('success'):
+                self.shipped += len(batch)
+                log.debug('Logged %s activities', len(batch))
+                return
+            self.failed += len(batch)
+            log.warning('Failed to log %s activities', len(batch))
+        except Exception as e:
+            self.failed += len(batch)
+            log.error('Error logging activities: %s', e)
+        if self.spool is not None:
+            self.spool.add_many('activity', batch)
+    
+    async def close(self, timeout=10.0):
+        if not self.task or self.loop is not asyncio.get_running_loop():
+            self.task = None
+            return
+        self.closing = True
+        try:
+            self.queue.put_nowait(_SHIPPER_STOP)
+        except asyncio.QueueFull:
+            pass
+        try:
+            await asyncio.wait_for(self.task, timeout)
+        except asyncio.TimeoutError:
+            pending = self.queue.qsize()
+            self.dropped += pending
+            log.warning('Activity shipper did not drain in time, dropped %s activities', pending)
+        except Exception as e:
+            log.error('Error draining activity shipper: %s', e)
+        self.task = None
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def configure(self, rate, capacity):
+        self._refill(time.monotonic())
+        was_unlimited = self.rate <= 0
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity if was_unlimited else min(self.tokens, capacity)
+    
+    def reserve(self):
+        # Takes a token now and returns how long the caller must wait for it.
+        # Tokens may go negative, which queues callers fairly without a lock.
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+class ExpiringCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def _purge(self, now):
+        while self.entries:
+            expires_at, _ = next(iter(self.entries.values()))
+            if expires_at > now and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+    
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+    
+    def set(self, key, value, ttl=None):
+        now = time.monotonic()
+        self.entries[key] = (now + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        self._purge(now)
+    
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+class RollingStats:
+    # A ring of fixed-width time buckets covering the longest window. Stale
+    # buckets are reused in place, so memory stays flat however long the bot runs.
+    WINDOWS = (('1m', 60), ('15m', 900), ('1h', 3600))
+    
+    def __init__(self, bucket_seconds=STATS_BUCKET_SECONDS):
+        self.bucket_seconds = max(1.0, bucket_seconds)
+        self.size = int(-(-self.WINDOWS[-1][1] // self.bucket_seconds))
+        self.buckets = [None] * self.size
+        self.totals = {'sent': 0, 'failed': 0}
+        self.started = time.monotonic()
+    
+    def _counts(self, now):
+        bucket_id = int(now // self.bucket_seconds)
+        bucket = self.buckets[bucket_id % self.size]
+        if bucket is None or bucket[0] != bucket_id:
+            bucket = self.buckets[bucket_id % self.size] = (bucket_id, {})
+        return bucket[1]
+    
+    def _inc(self, counts, key):
+        counts[key] = counts.get(key, 0) + 1
+    
+    def record_send(self, success, reason=None):
+        counts = self._counts(time.monotonic())
+        result = 'sent' if success else 'failed'
+        self.totals[result] += 1
+        self._inc(counts, result)
+        if not success:
+            self._inc(counts, ('reason', reason or 'error'))
+    
+    def record_message(self, template_name, variant, success):
+        counts = self._counts(time.monotonic())
+        result = 'sent' if success else 'failed'
+        self._inc(counts, ('template', template_name, result))
+        if variant is not None:
+            self._inc(counts, ('variant', template_name, variant, result))
+    
+    def _oldest(self, seconds, now):
+        return int(now // self.bucket_seconds) - int(seconds // self.bucket_seconds)
+    
+    def window(self, seconds, now=None):
+        now = time.monotonic() if now is None else now
+        oldest = self._oldest(seconds, now)
+        merged = {}
+        for bucket in self.buckets:
+            if bucket is not None and bucket[0] > oldest:
+                for key, count in bucket[1].items():
+                    merged[key] = merged.get(key, 0) + count
+        return merged
+    
+    def snapshot(self):
+        now = time.monotonic()
+        uptime = max(now - self.started, self.bucket_seconds)
+        sends_per_minute = {}
+        failure_rate = {}
+        for name, seconds in self.WINDOWS:
+            counts = self.window(seconds, now)
+            sent, failed = counts.get('sent', 0), counts.get('failed', 0)
+            # The newest bucket is still filling, so rate over the time actually covered
+            covered = now - (self._oldest(seconds, now) + 1) * self.bucket_seconds
+            sends_per_minute[name] = round(sent * 60 / max(min(covered, uptime), 1.0), 2)
+            failure_rate[name] = round(failed / (sent + failed), 4) if sent + failed else 0.0
+        # Breakdowns cover the longest window, whose counts the loop ended on
+        failures, templates, variants = {}, {}, {}
+        for key, count in counts.items():
+            if not isinstance(key, tuple):
+                continue
+            if key[0] == 'reason':
+                failures[key[1]] = count
+            elif key[0] == 'template':
+                templates.setdefault(key[1], {'sent': 0, 'failed': 0})[key[2]] = count
+            else:
+                variants.setdefault(key[1], {}).setdefault(key[2], {'sent': 0, 'failed': 0})[key[3]] = count
+        return {
+            'sent': self.totals['sent'],
+            'failed': self.totals['failed'],
+            'sends_per_minute': sends_per_minute,
+            'failure_rate': failure_rate,
+            'failures_1h': failures,
+            'templates_1h': templates,
+            'variants_1h': variants
+        }
+
+# Discord error codes that will fail the same way on every retry
+UNDELIVERABLE_CODES = {
+    50007: 'dms_disabled',
+    10013: 'unknown_user'
+}
+
+def undeliverable_reason(error):
+    code = getattr(error, 'code', 0)
+    if code in UNDELIVERABLE_CODES:
+        return UNDELIVERABLE_CODES[code]
+    # 40003 is "opening direct messages too fast", a rate limit rather than a refusal
+    if isinstance(error, discord.Forbidden) and code != 40003:
+        return 'forbidden'
+    return None
+
+def send_failure_reason(error):
+    reason = undeliverable_reason(error)
+    if reason is not None:
+        return reason
+    if isinstance(error, discord.HTTPException):
+        return 'rate_limited' if error.status == 429 or getattr(error, 'code', 0) == 40003 else 'http_error'
+    return 'error'
 
 class BotRateLimiter:
-    def __init__(self):
-        self.last_dm_time = {}
+    def __init__(self, global_rate=DM_GLOBAL_RATE / WORKER_COUNT, user_cache_size=DM_USER_CACHE_SIZE):
         self.rate_limit_delay = 1.0
+        self.max_dms_per_hour = 0
+        self.global_rate = global_rate
+        # Discord allows 50 requests/s per bot across all routes; a DM can
+        # cost two (open channel + post), so the global bucket sits below that.
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.hourly_bucket = TokenBucket(0, 0)
+        self.next_user_slot = ExpiringCache(user_cache_size, self.rate_limit_delay)
+        self.waits = 0
+        self.wait_seconds = 0.0
+        # Called with (user_id, reason) when a DM fails for good
+        self.on_undeliverable = None
+        self.dm_channels = None
+        self.controller = None
+        self.send_stats = None
+        self.global_waits = 0
+    
+    def configure(self, settings):
+        self.rate_limit_delay = float(settings.get('rate_limit_delay', 1.0))
+        self.next_user_slot.ttl = self.rate_limit_delay
+        max_dms_per_hour = int(settings.get('max_dms_per_hour') or 0)
+        if max_dms_per_hour != self.max_dms_per_hour:
+            self.max_dms_per_hour = max_dms_per_hour
+            self.hourly_bucket.configure(max_dms_per_hour / 3600.0, max_dms_per_hour)
+        global_rate = float(settings.get('global_dm_rate', DM_GLOBAL_RATE)) / WORKER_COUNT
+        if global_rate != self.global_rate:
+            self.global_rate = global_rate
+            self.global_bucket.configure(global_rate, max(1.0, global_rate))
+            if self.controller is not None:
+                self.controller.rebase()
+    
+    def stats(self):
+        return {
+            'rate_limit_delay': self.rate_limit_delay,
+            'max_dms_per_hour': self.max_dms_per_hour,
+            'global_rate': self.global_rate,
+            'tracked_users': len(self.next_user_slot),
+            'waits': self.waits,
+            'wait_seconds': round(self.wait_seconds, 3)
+        }
+    
+    async def _wait(self, delay):
+        if delay > 0:
+            self.waits += 1
+            self.wait_seconds += delay
+            RATE_LIMIT_WAIT_SECONDS.observe(delay)
+            await asyncio.sleep(delay)
+    
+    async def acquire(self, user_id):
+        now = time.monotonic()
+        user_slot = max(now, self.next_user_slot.get(user_id, now))
+        next_slot = user_slot + self.rate_limit_delay
+        self.next_user_slot.set(user_id, next_slot, next_slot - now)
+        await self._wait(user_slot - now)
+        global_delay = self.global_bucket.reserve()
+        if global_delay > 0:
+            self.global_waits += 1
+        await self._wait(max(self.hourly_bucket.reserve(), global_delay))
     
-    async def send_dm_safely(self, user, content, buttons=None):
+    def _undeliverable(self, user, error):
+        reason = undeliverable_reason(error)
+        if reason is not None and self.on_undeliverable is not None:
+            self.on_undeliverable(str(user.id), reason)
+    
+    async def _send(self, user, content, view):
+        kwargs = {'view': view} if view is not None else {}
+        user_id = str(user.id)
+        channel = self.dm_channels.channel(user_id) if self.dm_channels is not None else None
+        if channel is not None:
+            # Known DM channel: post straight to it, skipping the open-channel request
+            try:
+                return await channel.send(content, **kwargs)
+            except discord.NotFound:
+                self.dm_channels.drop(user_id)
+        message = await user.send(content, **kwargs)
+        if self.dm_channels is not None and message is not None:
+            self.dm_channels.set(user_id, message.channel.id)
+        return message
+    
+    async def send_dm_safely(self, user, content, buttons=None, view=None):
+        started = None
         try:
-            user_id = str(user.id)
-            current_time = time.time()
-            if user_id in self.last_dm_time:
-                time_since_last = current_time - self.last_dm_time[user_id]
-                if time_since_last < self.rate_limit_delay:
-                    await asyncio.sleep(self.rate_limit_delay - time_since_last)
-            self.last_dm_time[user_id] = time.time()
-            if buttons:
+            await self.acquire(str(user.id))
+            if view is None and buttons:
                 view = create_button_view(buttons)
-                await user.send(content, view=view)
-            else:
-                await user.send(content)
-            return True, None
-        except discord.Forbidden:
-            return False, 'User has DMs disabled'
+            started = time.perf_counter()
+            await self._send(user, content, view)
+            result = (True, None)
+            failure = None
+        except discord.Forbidden as e:
+            result = (False, 'User has DMs disabled')
+            failure = e
+            self._undeliverable(user, e)
         except discord.HTTPException as e:
-            return False, f'HTTP Error: {str(e)}'
+            result = (False, f'HTTP Error: {str(e)}')
+            failure = e
+            # A 429 that reaches here was already logged by discord.py on every
+            # attempt, and RateLimitLogHandler counted it there
+            self._undeliverable(user, e)
         except Exception as e:
-            return False, f'Unknown error: {str(e)}'
+            result = (False, f'Unknown error: {str(e)}')
+            failure = e
+        if started is not None:
+            latency = time.perf_counter() - started
+            DM_SEND_SECONDS.observe(latency)
+            if self.controller is not None:
+                self.controller.record(latency)
+        DMS_TOTAL.inc(result='sent' if result[0] else 'failed')
+        if self.send_stats is not None:
+            self.send_stats.record_send(result[0], send_failure_reason(failure) if failure is not None else None)
+        return result
+
+class SendRateController:
+    # AIMD over fixed windows: the rate creeps up while sends are being held
+    # back by it and Discord stays fast, and is cut on 429s or slow sends.
+    INCREASE = 1.0
+    RATE_LIMIT_DECREASE = 0.5
+    LATENCY_DECREASE = 0.85
+    
+    def __init__(self, rate_limiter, dispatcher, min_rate=ADAPTIVE_MIN_RATE,
+                 latency_target=ADAPTIVE_LATENCY_TARGET, window=ADAPTIVE_WINDOW):
+        self.rate_limiter = rate_limiter
+        self.dispatcher = dispatcher
+        self.min_rate = max(0.1, min_rate)
+        self.latency_target = latency_target
+        self.window = window
+        self.rate = None
+        self.latency = None
+        self.window_started = time.monotonic()
+        self.window_latencies = []
+        self.window_rate_limits = 0
+        self.window_waits = rate_limiter.global_waits
+        self.last_decision = None
+    
+    def ceiling(self):
+        return self.rate_limiter.global_rate
+    
+    def record(self, latency):
+        self.window_latencies.append(latency)
+        # Smoothed latency for sizing concurrency (Little's law)
+        self.latency = latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+        self.maybe_adjust()
+    
+    def record_rate_limit(self):
+        self.window_rate_limits += 1
+        DISCORD_RATE_LIMITS_TOTAL.inc()
+        self.maybe_adjust()
+    
+    def maybe_adjust(self):
+        now = time.monotonic()
+        if now - self.window_started < self.window:
+            return None
+        decision = self.adjust()
+        self.window_started = now
+        self.window_latencies = []
+        self.window_rate_limits = 0
+        self.window_waits = self.rate_limiter.global_waits
+        return decision
+    
+    def adjust(self):
+        ceiling = self.ceiling()
+        if ceiling <= 0:
+            return None
+        rate = ceiling if self.rate is None else min(self.rate, ceiling)
+        latencies = sorted(self.window_latencies)
+        p90 = latencies[int(len(latencies) * 0.9)] if latencies else 0.0
+        if self.window_rate_limits:
+            decision = 'rate_limited'
+            rate *= self.RATE_LIMIT_DECREASE
+        elif p90 > self.latency_target:
+            decision = 'slow'
+            rate *= self.LATENCY_DECREASE
+        elif self.rate_limiter.global_waits > self.window_waits and rate < ceiling:
+            # Only speed up when the current rate is what is holding sends back
+            decision = 'increase'
+            rate += self.INCREASE
+        else:
+            decision = 'hold'
+        self.apply(max(self.min_rate, min(rate, ceiling)))
+        self.last_decision = decision
+        RATE_DECISIONS_TOTAL.inc(decision=decision)
+        if decision != 'hold':
+            log.info('Send rate %s: %.1f DMs/s, concurrency %s', decision, self.rate, self.dispatcher.concurrency,
+                     extra={'event': 'rate_adjusted', 'decision': decision, 'rate': self.rate})
+        return decision
+    
+    def rebase(self):
+        # The rate limiter rebuilt its bucket at a new ceiling; carry the
+        # learned rate over, clamped to it, so bucket and controller agree
+        ceiling = self.ceiling()
+        rate, self.rate = self.rate, None
+        if ceiling > 0:
+            self.apply(ceiling if rate is None else max(self.min_rate, min(rate, ceiling)))
+    
+    def apply(self, rate):
+        if rate != self.rate:
+            self.rate = rate
+            self.rate_limiter.global_bucket.configure(rate, max(1.0, rate))
+        latency = self.latency if self.latency is not None else self.latency_target
+        # Enough sends in flight to keep up with the rate at the observed latency
+        self.dispatcher.concurrency = max(1, min(self.dispatcher.max_concurrency, int(rate * latency * 2) + 2))
+        SEND_RATE.set(self.rate)
+        SEND_CONCURRENCY.set(self.dispatcher.concurrency)
+    
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'ceiling': self.ceiling(),
+            'concurrency': self.dispatcher.concurrency,
+            'latency': round(self.latency, 4) if self.latency is not None else None,
+            'last_decision': self.last_decision
+        }
+
+class RateLimitLogHandler(logging.Handler):
+    # discord.py retries 429s itself and only logs them, so that log is the signal
+    def __init__(self, controller):
+        super().__init__(logging.WARNING)
+        self.controller = controller
+    
+    def emit(self, record):
+        # A global 429 is also followed by a 'Global rate limit has been hit'
+        # warning; only the per-response line is counted, so each 429 counts once
+        if 'responded with 429' in str(record.msg):
+            self.controller.record_rate_limit()
+
+_DISPATCH_DONE = object()
+
+class CampaignDispatcher:
+    def __init__(self, concurrency=CAMPAIGN_CONCURRENCY, max_concurrency=None):
+        self.concurrency = max(1, concurrency)
+        # Workers above concurrency stay parked until it is raised mid-run
+        self.max_concurrency = max(self.concurrency, max_concurrency or self.concurrency)
+        self.active_runs = {}
+        self.last_run_stats = {}
+    
+    def cancel(self, campaign_name):
+        cancel_event = self.active_runs.get(campaign_name)
+        if cancel_event is None:
+            return False
+        cancel_event.set()
+        return True
+    
+    async def run(self, campaign_name, users, handler):
+        cancel_event = asyncio.Event()
+        self.active_runs[campaign_name] = cancel_event
+        queue = asyncio.Queue(maxsize=max(self.concurrency, self.max_concurrency) * 2)
+        stats = {'campaign': campaign_name, 'sent': 0, 'failed': 0, 'skipped': 0, 'errors': 0, 'cancelled': False}
+        started = time.perf_counter()
+        producer_done = False
+        
+        async def worker(index):
+            while True:
+                if index >= self.concurrency:
+                    # Parked while concurrency is below this worker's slot
+                    if producer_done:
+                        return
+                    await asyncio.sleep(0.25)
+                    continue
+                user = await queue.get()
+                if user is _DISPATCH_DONE:
+                    # Leave the marker in place for the next worker
+                    queue.put_nowait(_DISPATCH_DONE)
+                    return
+                if cancel_event.is_set():
+                    continue
+                try:
+                    success = await handler(user)
+                    if success is None:
+                        stats['skipped'] += 1
+                    else:
+                        stats['sent' if success else 'failed'] += 1
+                except Exception as e:
+                    stats['errors'] += 1
+                    log.error('Error dispatching to user %s: %s', user.id, e, extra={'event': 'dispatch_error'})
+        
+        workers = [asyncio.ensure_future(worker(index)) for index in range(max(self.concurrency, self.max_concurrency))]
+        try:
+            for user in users:
+                if cancel_event.is_set():
+                    break
+                await queue.put(user)
+            producer_done = True
+            await queue.put(_DISPATCH_DONE)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            if self.active_runs.get(campaign_name) is cancel_event:
+                del self.active_runs[campaign_name]
+            elapsed = time.perf_counter() - started
+            processed = stats['sent'] + stats['failed'] + stats['skipped'] + stats['errors']
+            stats['cancelled'] = cancel_event.is_set()
+            stats['elapsed_seconds'] = round(elapsed, 3)
+            stats['users_per_second'] = round(processed / elapsed, 2) if elapsed > 0 else 0.0
+            self.last_run_stats[campaign_name] = stats
+            log.info('Campaign %s: %s sent, %s failed, %s skipped, %s errors in %.1fs (%s users/s)%s',
+                     campaign_name, stats['sent'], stats['failed'], stats['skipped'], stats['errors'], elapsed,
+                     stats['users_per_second'], ' [cancelled]' if stats['cancelled'] else '',
+                     extra={'event': 'campaign_finished', 'stats': stats})
+        return stats
+
+class RealtimeQueue:
+    def __init__(self, handler, workers=REALTIME_WORKERS, max_size=ACTIVITY_QUEUE_SIZE):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.pending = set()
+        self.queue = None
+        self.tasks = []
+        self.loop = None
+        self.enqueued = 0
+        self.duplicates = 0
+        self.dropped = 0
+    
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.tasks and self.loop is loop:
+            return
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self.pending = set()
+        self.tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+    
+    def enqueue(self, key, *args):
+        self.start()
+        if key in self.pending:
+            self.duplicates += 1
+            return False
+        try:
+            self.queue.put_nowait((key, args))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.pending.add(key)
+        self.enqueued += 1
+        return True
+    
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'enqueued': self.enqueued,
+            'duplicates': self.duplicates,
+            'dropped': self.dropped
+        }
+    
+    async def _worker(self):
+        while True:
+            key, args = await self.queue.get()
+            try:
+                await self.handler(*args)
+            except Exception as e:
+                log.error('Error in real-time send: %s', e)
+            finally:
+                self.pending.discard(key)
+    
+    async def close(self):
+        if self.loop is not asyncio.get_running_loop():
+            self.tasks = []
+            return
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+class CampaignScheduler:
+    def __init__(self, default_interval=RECONCILE_INTERVAL, jitter=SCHEDULER_JITTER,
+                 max_concurrent=SCHEDULER_MAX_CONCURRENT, max_backoff=SCHEDULER_MAX_BACKOFF):
+        self.default_interval = default_interval
+        self.jitter = max(0.0, jitter)
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_backoff = max(1.0, max_backoff)
+        self.entries = {}
+        self.running = {}
+        self.wakeup = None
+        self.runs = 0
+    
+    def update(self, config):
+        # A template is due right away when it is new or when it, or the roles
+        # it targets, changed; otherwise it keeps its place in the schedule.
+        now = time.monotonic()
+        settings = config.get('settings') or {}
+        default_interval = self.interval(settings.get('campaign_interval_minutes'), self.default_interval)
+        target_roles = config.get('target_roles', [])
+        names = set()
+        for template in config.get('message_templates', []):
+            name = template.get('name', 'unnamed')
+            names.add(name)
+            interval = self.interval(template.get('interval_minutes'), default_interval)
+            priority = int(template.get('priority', 0))
+            # Scheduling fields are applied in place below instead of forcing a run
+            digest = config_hash([template_message_fields(template), target_roles])
+            entry = self.entries.get(name)
+            if entry is None or entry['hash'] != digest:
+                self.entries[name] = entry = {
+                    'name': name, 'template': template, 'hash': digest, 'interval': interval,
+                    'priority': priority, 'next_run': now, 'last_run': None, 'idle_runs': 0, 'last_stats': None
+                }
+            else:
+                entry['template'] = template
+                entry['priority'] = priority
+                if entry['interval'] != interval:
+                    entry['interval'] = interval
+                    if entry['last_run'] is not None:
+                        entry['next_run'] = entry['last_run'] + self.delay(entry)
+            self._publish(entry)
+        for name in list(self.entries):
+            if name not in names:
+                del self.entries[name]
+                CAMPAIGN_NEXT_RUN.values.pop((('template', name),), None)
+        self._wake()
+    
+    def interval(self, minutes, default):
+        if minutes is None:
+            return default
+        try:
+            seconds = float(minutes) * 60
+        except (TypeError, ValueError):
+            seconds = 0
+        if seconds <= 0:
+            log.warning('Ignoring interval_minutes=%r, using %.0f minutes', minutes, default / 60)
+            return default
+        return max(seconds, SCHEDULER_MIN_INTERVAL)
+    
+    def delay(self, entry):
+        # Templates whose last runs found nobody to message back off, up to
+        # max_backoff times their interval; any delivery resets them.
+        interval = entry['interval'] * min(2 ** entry['idle_runs'], self.max_backoff)
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0.0, interval)
+    
+    def _publish(self, entry):
+        CAMPAIGN_NEXT_RUN.set(round(time.time() + entry['next_run'] - time.monotonic(), 3), template=entry['name'])
+    
+    def _wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+    
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        due = [entry for name, entry in self.entries.items()
+               if name not in self.running and entry['next_run'] <= now]
+        due.sort(key=lambda entry: (-entry['priority'], entry['next_run']))
+        return due
+    
+    def start_due(self, runner):
+        started = []
+        for entry in self.due()[:self.max_concurrent - len(self.running)]:
+            self.running[entry['name']] = asyncio.ensure_future(self._run(entry, runner))
+            started.append(entry['name'])
+        return started
+    
+    async def _run(self, entry, runner):
+        stats = None
+        try:
+            stats = await runner(entry['template'])
+        finally:
+            self.running.pop(entry['name'], None)
+            self.runs += 1
+            entry['last_run'] = time.monotonic()
+            entry['last_stats'] = stats
+            if stats and stats['sent'] + stats['failed'] + stats['errors'] == 0:
+                entry['idle_runs'] += 1
+            else:
+                entry['idle_runs'] = 0
+            entry['next_run'] = entry['last_run'] + self.delay(entry)
+            self._publish(entry)
+            self._wake()
+    
+    def next_wakeup(self):
+        waiting = [entry['next_run'] for name, entry in self.entries.items() if name not in self.running]
+        return min(waiting) if waiting else None
+    
+    async def wait(self, deadline, active=True):
+        # Sleep until the next template is due, a run frees a slot, the config
+        # changes, or deadline (monotonic) passes, whichever comes first. While
+        # paused nothing can start, so due templates must not cut the sleep short.
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        next_run = self.next_wakeup()
+        if active and next_run is not None and len(self.running) < self.max_concurrent:
+            deadline = min(deadline, next_run)
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            # Always yield, so a caller looping on wait() cannot starve the event loop
+            await asyncio.sleep(0)
+            return
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def schedule(self):
+        now = time.monotonic()
+        wall = time.time()
+        return [{
+            'template': entry['name'],
+            'priority': entry['priority'],
+            'interval_seconds': entry['interval'],
+            'running': entry['name'] in self.running,
+            'next_run': datetime.fromtimestamp(wall + entry['next_run'] - now).isoformat(),
+            'idle_runs': entry['idle_runs']
+        } for entry in sorted(self.entries.values(), key=lambda entry: entry['next_run'])]
+    
+    async def close(self):
+        tasks = list(self.running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.running = {}
+        self.wakeup = None
+
+class RoleIndex:
+    def __init__(self):
+        self.members_by_role = {}
+        self.roles_by_guild = {}
+    
+    def is_indexed(self, guild):
+        return guild.id in self.roles_by_guild
+    
+    def index_guild(self, guild):
+        self.drop_guild(guild)
+        self.roles_by_guild[guild.id] = set()
+        for member in guild.members:
+            self.add_member(member)
+    
+    def drop_guild(self, guild):
+        for role_id in self.roles_by_guild.pop(guild.id, ()):
+            self.members_by_role.pop(role_id, None)
+    
+    def drop_role(self, role):
+        role_id = str(role.id)
+        self.members_by_role.pop(role_id, None)
+        self.roles_by_guild.get(role.guild.id, set()).discard(role_id)
+    
+    def add_member(self, member, roles=None):
+        guild_roles = self.roles_by_guild.get(member.guild.id)
+        if guild_roles is None:
+            return
+        for role in member.roles if roles is None else roles:
+            role_id = str(role.id)
+            members = self.members_by_role.get(role_id)
+            if members is None:
+                members = self.members_by_role[role_id] = set()
+                guild_roles.add(role_id)
+            members.add(member.id)
+    
+    def remove_member(self, member, roles=None):
+        for role in member.roles if roles is None else roles:
+            members = self.members_by_role.get(str(role.id))
+            if members is not None:
+                members.discard(member.id)
+    
+    def update_member(self, before, after):
+        before_roles = set(before.roles)
+        after_roles = set(after.roles)
+        if before_roles == after_roles:
+            return
+        self.remove_member(after, before_roles - after_roles)
+        self.add_member(after, after_roles - before_roles)
+    
+    def member_ids(self, role_ids):
+        return set().union(*(self.members_by_role.get(role_id, ()) for role_id in role_ids))
+    
+    def members_with_roles(self, guild, role_ids):
+        # Role IDs are unique per guild, so only this guild's roles can match
+        guild_role_ids = self.roles_by_guild.get(guild.id, set()).intersection(role_ids)
+        members = []
+        for member_id in self.member_ids(guild_role_ids):
+            member = guild.get_member(member_id)
+            if member is not None:
+                members.append(member)
+        return members
+
+class Base44Spool:
+    def __init__(self, base44_client, bot_id, path=BASE44_SPOOL_PATH, max_rows=BASE44_SPOOL_MAX_ROWS,
+                 replay_interval=BASE44_SPOOL_REPLAY_INTERVAL, batch_size=ACTIVITY_BATCH_SIZE,
+                 max_attempts=BASE44_SPOOL_MAX_ATTEMPTS):
+        self.base44_client = base44_client
+        self.bot_id = bot_id
+        self.path = path
+        self.max_rows = max_rows
+        self.max_attempts = max_attempts
+        self.replay_interval = replay_interval
+        self.batch_size = max(1, batch_size)
+        self.pending = []
+        self.conn = None
+        # Same pattern as the delivery ledger: one thread owns the connection
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='base44-spool')
+        self.task = None
+        self.loop = None
+        self.depth = 0
+        self.oldest = None
+        self.spooled = 0
+        self.replayed = 0
+        self.rejected = 0
+        self.dropped = 0
+        # When the last live status reached Base44; older spooled ones are stale
+        self.status_delivered_at = 0.0
+    
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS spool ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, '
+                'payload TEXT NOT NULL, created_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)'
+            )
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(spool)')}
+            if 'attempts' not in columns:
+                self.conn.execute('ALTER TABLE spool ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+        return self.conn
+    
+    async def _run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+    
+    def _summary(self, conn):
+        depth, oldest = conn.execute('SELECT COUNT(*), MIN(created_at) FROM spool').fetchone()
+        return depth, oldest
+    
+    def _append(self, rows):
+        conn = self._connect()
+        dropped = 0
+        with conn:
+            conn.executemany('INSERT INTO spool (kind, payload, created_at) VALUES (?, ?, ?)', rows)
+            # Status reports supersede each other; only the latest is worth replaying
+            conn.execute("DELETE FROM spool WHERE kind = 'status' AND id < (SELECT MAX(id) FROM spool WHERE kind = 'status')")
+            depth, _ = self._summary(conn)
+            if depth > self.max_rows:
+                dropped = depth - self.max_rows
+                conn.execute('DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)', (dropped,))
+        return (dropped, *self._summary(conn))
+    
+    def _read(self):
+        conn = self._connect()
+        status = conn.execute("SELECT id, payload, created_at FROM spool WHERE kind = 'status' ORDER BY id DESC LIMIT 1").fetchone()
+        activities = conn.execute("SELECT id, payload FROM spool WHERE kind = 'activity' ORDER BY id LIMIT ?",
+                                  (self.batch_size,)).fetchall()
+        return status, activities
+    
+    def _delete(self, ids):
+        conn = self._connect()
+        with conn:
+            conn.executemany('DELETE FROM spool WHERE id = ?', [(row_id,) for row_id in ids])
+        return self._summary(conn)
+    
+    def _attempted(self, ids):
+        conn = self._connect()
+        with conn:
+            conn.executemany('UPDATE spool SET attempts = attempts + 1 WHERE id = ?', [(row_id,) for row_id in ids])
+            dropped = 0
+            if self.max_attempts > 0:
+                dropped = conn.execute('DELETE FROM spool WHERE attempts >= ?', (self.max_attempts,)).rowcount
+        return (dropped, *self._summary(conn))
+    
+    def status_delivered(self):
+        # A newer status went through live, so any spooled one must never be
+        # replayed after it; it is discarded on the next replay instead
+        self.status_delivered_at = time.time()
+        self.pending = [row for row in self.pending if row[0] != 'status']
+    
+    def add(self, kind, payload):
+        self.add_many(kind, [payload])
+    
+    def add_many(self, kind, payloads):
+        # Only buffered here; the worker writes and fsyncs them in batches
+        now = time.time()
+        self.pending.extend((kind, json.dumps(payload, default=str), now) for payload in payloads)
+        self.spooled += len(payloads)
+        self.start()
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            dropped, self.depth, self.oldest = await self._run_in_executor(self._append, rows)
+        except Exception as e:
+            log.error('Error writing Base44 spool: %s', e)
+            return
+        if dropped:
+            self.dropped += dropped
+            SPOOL_DROPPED_TOTAL.inc(dropped, reason='full')
+            log.warning('Base44 spool full, dropped %s oldest entries', dropped)
+    
+    async def _replay_rows(self, kind, rows, result):
+        # Returns True when the rows left the spool, False when they stay for a retry
+        ids = [row[0] for row in rows]
+        if result and result.get('success'):
+            self.depth, self.oldest = await self._run_in_executor(self._delete, ids)
+            self.replayed += len(ids)
+            SPOOL_REPLAYED_TOTAL.inc(len(ids), kind=kind)
+            log.info('Replayed %s spooled %s entries, %s left', len(ids), kind, self.depth)
+            return True
+        if result is not None:
+            # Base44 answered and refused them (4xx or success: false); a retry
+            # would be refused too and only hold up the rows behind them
+            self.depth, self.oldest = await self._run_in_executor(self._delete, ids)
+            self.rejected += len(ids)
+            self.dropped += len(ids)
+            SPOOL_DROPPED_TOTAL.inc(len(ids), reason='rejected')
+            log.warning('Base44 rejected %s spooled %s entries (status %s), dropping them',
+                        len(ids), kind, result.get('status'), extra={'event': 'spool_rejected'})
+            return True
+        dropped, self.depth, self.oldest = await self._run_in_executor(self._attempted, ids)
+        if dropped:
+            self.dropped += dropped
+            SPOOL_DROPPED_TOTAL.inc(dropped, reason='attempts')
+            log.warning('Dropped %s spooled entries after %s replay attempts', dropped, self.max_attempts)
+        return False
+    
+    async def replay(self):
+        # The latest status and the activities are replayed independently, so
+        # one failing never holds up the other. Activities go oldest-first and
+        # stop at the first batch that fails for a transient reason.
+        if self.base44_client.breaker.state == 'open':
+            return
+        status, activities = await self._run_in_executor(self._read)
+        if status is not None and status[2] <= self.status_delivered_at:
+            self.depth, self.oldest = await self._run_in_executor(self._delete, [status[0]])
+        elif status is not None:
+            result = await self.base44_client.update_bot_status(json.loads(status[1]))
+            await self._replay_rows('status', [status], result)
+        while activities:
+            result = await self.base44_client.log_bot_activity_batch(
+                self.bot_id, [json.loads(row[1]) for row in activities])
+            if not await self._replay_rows('activity', activities, result):
+                return
+            _, activities = await self._run_in_executor(self._read)
+    
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.task and not self.task.done() and self.loop is loop:
+            return
+        self.loop = loop
+        self.task = loop.create_task(self._run())
+    
+    async def _run(self):
+        try:
+            self.depth, self.oldest = await self._run_in_executor(lambda: self._summary(self._connect()))
+        except Exception as e:
+            log.error('Error opening Base44 spool: %s', e)
+        if self.depth:
+            log.info('Base44 spool holds %s unsent entries', self.depth)
+        next_replay = 0
+        while True:
+            await asyncio.sleep(1)
+            await self.flush()
+            if self.depth and time.monotonic() >= next_replay:
+                next_replay = time.monotonic() + self.replay_interval
+                try:
+                    await self.replay()
+                except Exception as e:
+                    log.error('Error replaying Base44 spool: %s', e)
+    
+    def backlog_age(self):
+        return time.time() - self.oldest if self.depth and self.oldest else 0.0
+    
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'pending': len(self.pending),
+            'backlog_age_seconds': round(self.backlog_age(), 1),
+            'spooled': self.spooled,
+            'replayed': self.replayed,
+            'rejected': self.rejected,
+            'dropped': self.dropped
+        }
+    
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+    
+    async def close(self):
+        if self.task is not None and self.loop is asyncio.get_running_loop():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        await self.flush()
+        await self._run_in_executor(self._close)
+
+class DeliveryLedger:
+    LOOKUP_CHUNK = 500
+    CLAIM_TTL = 3600
+    
+    def __init__(self, path=DELIVERY_LEDGER_PATH, flush_size=100):
+        self.path = path
+        self.flush_size = flush_size
+        self.pending = []
+        self.conn = None
+        # sqlite3 connections are bound to their thread, so every query runs
+        # on this single worker and never blocks the event loop. Stores that
+        # keep tables in this database (campaign runs, undeliverable users,
+        # DM channels) use connect() from functions they pass to run().
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='delivery-ledger')
+        # Deliveries from this session, and sends still in flight, claimed
+        # right before sending so the sweep and the real-time path cannot
+        # both message the same user.
+        self.recent = ExpiringCache(DM_USER_CACHE_SIZE, 3600)
+        self.skipped = 0
+        self.recorded = 0
+        self.claimed_elsewhere = 0
+    
+    @staticmethod
+    def campaign_version(template):
+        if template.get('version') is not None:
+            return str(template['version'])
+        # Retuning cadence or priority must not re-send the campaign to everyone
+        return config_hash(template_message_fields(template))[:16]
+    
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS deliveries ('
+                'user_id TEXT NOT NULL, template TEXT NOT NULL, version TEXT NOT NULL, '
+                'sent_at REAL NOT NULL, PRIMARY KEY (user_id, template, version)) WITHOUT ROWID'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS campaign_runs ('
+                'run_id TEXT PRIMARY KEY, template TEXT NOT NULL, version TEXT NOT NULL, '
+                'status TEXT NOT NULL, cursor INTEGER NOT NULL, total INTEGER NOT NULL, '
+                "started_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT NOT NULL DEFAULT '')"
+            )
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(campaign_runs)')}
+            if 'owner' not in columns:
+                self.conn.execute("ALTER TABLE campaign_runs ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS campaign_audience ('
+                'run_id TEXT NOT NULL, position INTEGER NOT NULL, user_id TEXT NOT NULL, '
+                'guild_id TEXT NOT NULL, PRIMARY KEY (run_id, position)) WITHOUT ROWID'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS undeliverable ('
+                'user_id TEXT PRIMARY KEY, reason TEXT NOT NULL, failed_at REAL NOT NULL, '
+                'expires_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS dm_channels ('
+                'user_id TEXT PRIMARY KEY, channel_id TEXT NOT NULL, updated_at REAL NOT NULL) WITHOUT ROWID'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS delivery_claims ('
+                'user_id TEXT NOT NULL, template TEXT NOT NULL, version TEXT NOT NULL, '
+                'claimed_at REAL NOT NULL, PRIMARY KEY (user_id, template, version)) WITHOUT ROWID'
+            )
+        return self.conn
+    
+    def _delivered(self, user_ids, template_name, version, since):
+        conn = self.connect()
+        delivered = set()
+        for i in range(0, len(user_ids), self.LOOKUP_CHUNK):
+            chunk = user_ids[i:i + self.LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(
+                f'SELECT user_id FROM deliveries WHERE user_id IN ({placeholders}) '
+                'AND template = ? AND version = ? AND sent_at >= ?',
+                (*chunk, template_name, version, since)
+            )
+            delivered.update(row[0] for row in rows)
+        return delivered
+    
+    def _insert(self, rows):
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO deliveries (user_id, template, version, sent_at) VALUES (?, ?, ?, ?)',
+                rows
+            )
+            conn.execute('DELETE FROM delivery_claims WHERE claimed_at < ?', (time.time() - self.CLAIM_TTL,))
+    
+    def _claim(self, key, since):
+        conn = self.connect()
+        now = time.time()
+        if conn.execute('SELECT 1 FROM deliveries WHERE user_id = ? AND template = ? AND version = ? AND sent_at >= ?',
+                        (*key, since)).fetchone():
+            return False
+        with conn:
+            if conn.execute('INSERT OR IGNORE INTO delivery_claims (user_id, template, version, claimed_at) '
+                            'VALUES (?, ?, ?, ?)', (*key, now)).rowcount:
+                return True
+            # A claim older than CLAIM_TTL was left behind by a worker that died mid-send
+            return conn.execute('UPDATE delivery_claims SET claimed_at = ? WHERE user_id = ? AND template = ? '
+                                'AND version = ? AND claimed_at < ?', (now, *key, now - self.CLAIM_TTL)).rowcount > 0
+    
+    def _unclaim(self, key):
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM delivery_claims WHERE user_id = ? AND template = ? AND version = ?', key)
+    
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+    
+    async def delivered_user_ids(self, user_ids, template_name, version, resend_hours=0):
+        # resend_hours <= 0 means a user gets each campaign version only once.
+        since = time.time() - resend_hours * 3600 if resend_hours > 0 else 0
+        delivered = await self.run(self._delivered, list(user_ids), template_name, version, since)
+        self.skipped += len(delivered)
+        return delivered
+    
+    def recently_recorded(self, user_id, template_name, version):
+        return self.recent.get((user_id, template_name, version)) is not None
+    
+    async def claim(self, user_id, template_name, version, resend_hours=0):
+        # Synchronous check-and-set first, so no other send in this process
+        # can slip in; then a claim row in the database, which workers sharing
+        # the ledger see even before this delivery is flushed.
+        key = (user_id, template_name, version)
+        if self.recent.get(key) is not None:
+            return False
+        self.recent.set(key, 'sending')
+        since = time.time() - resend_hours * 3600 if resend_hours > 0 else 0
+        try:
+            claimed = await self.run(self._claim, key, since)
+        except BaseException:
+            self.recent.pop(key)
+            raise
+        if not claimed:
+            self.recent.pop(key)
+            self.claimed_elsewhere += 1
+        return claimed
+    
+    async def release(self, user_id, template_name, version):
+        key = (user_id, template_name, version)
+        self.recent.pop(key)
+        try:
+            await self.run(self._unclaim, key)
+        except Exception as e:
+            log.error('Error releasing delivery claim: %s', e)
+    
+    async def record(self, user_id, template_name, version):
+        self.recent.set((user_id, template_name, version), True)
+        self.pending.append((user_id, template_name, version, time.time()))
+        if len(self.pending) >= self.flush_size:
+            await self.flush()
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            await self.run(self._insert, rows)
+            self.recorded += len(rows)
+        except Exception as e:
+            log.error('Error writing delivery ledger: %s', e)
+    
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+    
+    async def close(self):
+        await self.flush()
+        await self.run(self._close)
+
+class UndeliverableCache:
+    def __init__(self, ledger, ttl_hours=UNDELIVERABLE_TTL_HOURS):
+        self.ledger = ledger
+        self.ttl = ttl_hours * 3600
+        # user_id -> [failed_at, expires_at, reason, hits]
+        self.entries = {}
+        self.pending = {}
+        self.loaded = False
+        self.hits = 0
+        self.added = 0
+    
+    def _load(self):
+        conn = self.ledger.connect()
+        with conn:
+            conn.execute('DELETE FROM undeliverable WHERE expires_at <= ?', (time.time(),))
+        return conn.execute('SELECT user_id, failed_at, expires_at, reason, hits FROM undeliverable').fetchall()
+    
+    async def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            for user_id, failed_at, expires_at, reason, hits in await self.ledger.run(self._load):
+                self.entries.setdefault(user_id, [failed_at, expires_at, reason, hits])
+        except Exception as e:
+            log.error('Error loading undeliverable users: %s', e)
+    
+    def add(self, user_id, reason):
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        entry = [now, now + self.ttl, reason, 0]
+        self.entries[user_id] = entry
+        self.pending[user_id] = entry
+        self.added += 1
+    
+    def reason(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            # Expired: the user gets one more try
+            del self.entries[user_id]
+            return None
+        return entry[2]
+    
+    def hit(self, user_id):
+        reason = self.reason(user_id)
+        if reason is None:
+            return False
+        entry = self.entries[user_id]
+        entry[3] += 1
+        self.pending[user_id] = entry
+        self.hits += 1
+        UNDELIVERABLE_SKIPPED.inc(reason=reason)
+        return True
+    
+    def filter(self, user_ids):
+        # Returns the undeliverable subset of user_ids, counting a hit for each
+        return {user_id for user_id in self.entries.keys() & user_ids if self.hit(user_id)}
+    
+    def _write(self, rows):
+        conn = self.ledger.connect()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO undeliverable (user_id, failed_at, expires_at, reason, hits) '
+                'VALUES (?, ?, ?, ?, ?)', rows
+            )
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        rows = [(user_id, *entry) for user_id, entry in self.pending.items()]
+        self.pending = {}
+        try:
+            await self.ledger.run(self._write, rows)
+        except Exception as e:
+            log.error('Error writing undeliverable users: %s', e)
+    
+    def stats(self):
+        by_reason = {}
+        for entry in self.entries.values():
+            by_reason[entry[2]] = by_reason.get(entry[2], 0) + 1
+        return {'entries': len(self.entries), 'added': self.added, 'hits': self.hits, 'by_reason': by_reason}
+
+class DMChannelCache:
+    def __init__(self, ledger, max_size=DM_USER_CACHE_SIZE):
+        self.ledger = ledger
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.prewarmed = 0
+    
+    def _load(self):
+        return self.ledger.connect().execute(
+            'SELECT user_id, channel_id FROM dm_channels ORDER BY updated_at DESC LIMIT ?', (self.max_size,)
+        ).fetchall()
+    
+    async def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            rows = await self.ledger.run(self._load)
+            # Oldest first, so the most recently used are the last to be evicted
+            for user_id, channel_id in reversed(rows):
+                self.entries.setdefault(user_id, int(channel_id))
+            if rows:
+                log.info('Loaded %s cached DM channels', len(rows))
+        except Exception as e:
+            log.error('Error loading DM channels: %s', e)
+    
+    def channel(self, user_id):
+        channel_id = self.entries.get(user_id)
+        if channel_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return discord_bot.get_partial_messageable(channel_id, type=discord.ChannelType.private)
+    
+    def set(self, user_id, channel_id):
+        if self.entries.get(user_id) == channel_id:
+            return
+        self.entries[user_id] = channel_id
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.pending[user_id] = channel_id
+    
+    def drop(self, user_id):
+        self.entries.pop(user_id, None)
+        self.pending[user_id] = None
+    
+    def _write(self, rows):
+        conn = self.ledger.connect()
+        now = time.time()
+        with conn:
+            conn.executemany('DELETE FROM dm_channels WHERE user_id = ?',
+                             [(user_id,) for user_id, channel_id in rows if channel_id is None])
+            conn.executemany('INSERT OR REPLACE INTO dm_channels (user_id, channel_id, updated_at) VALUES (?, ?, ?)',
+                             [(user_id, str(channel_id), now) for user_id, channel_id in rows if channel_id is not None])
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        rows = list(self.pending.items())
+        self.pending = {}
+        try:
+            await self.ledger.run(self._write, rows)
+        except Exception as e:
+            log.error('Error writing DM channels: %s', e)
+    
+    async def prewarm(self, users, rate_limiter, limit=DM_PREWARM_LIMIT, concurrency=DM_PREWARM_CONCURRENCY):
+        # Opens DM channels ahead of a campaign so its sends are a single
+        # request each; opening still goes through the global rate limit.
+        users = [user for user in users if str(user.id) not in self.entries][:max(0, limit)]
+        if not users:
+            return 0
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        opened = 0
+        
+        async def open_channel(user):
+            nonlocal opened
+            async with semaphore:
+                try:
+                    channel = user.dm_channel
+                    if channel is None:
+                        await rate_limiter._wait(rate_limiter.global_bucket.reserve())
+                        channel = await user.create_dm()
+                    self.set(str(user.id), channel.id)
+                    opened += 1
+                except Exception as e:
+                    log.debug('Could not open DM channel for %s: %s', user.id, e)
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(open_channel(user) for user in users))
+        self.prewarmed += opened
+        log.info('Pre-warmed %s DM channels in %.1fs', opened, time.perf_counter() - started)
+        await self.flush()
+        return opened
+    
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'prewarmed': self.prewarmed}
+
+class CampaignRun:
+    def __init__(self, run_id, template_name, version, cursor=0, total=0):
+        self.run_id = run_id
+        self.template_name = template_name
+        self.version = version
+        self.cursor = cursor
+        self.total = total
+        self.done = set()
+        self.since_checkpoint = 0
+    
+    def complete(self, position):
+        # Workers finish out of order; the cursor only moves past a position
+        # once everything before it is done, so a resume never skips a user.
+        self.done.add(position)
+        self.since_checkpoint += 1
+        while self.cursor in self.done:
+            self.done.remove(self.cursor)
+            self.cursor += 1
+
+def campaign_run_owner():
+    # Workers from launch_shards.py can share one ledger; each only resumes
+    # runs over its own shards, whose guilds it can actually see.
+    if SHARD_IDS:
+        return f"{SHARD_COUNT}:{','.join(str(shard_id) for shard_id in SHARD_IDS)}"
+    return WORKER_ID or ''
+
+class CampaignRunStore:
+    def __init__(self, ledger, checkpoint_every=CAMPAIGN_CHECKPOINT_EVERY, owner=None):
+        self.ledger = ledger
+        self.owner = campaign_run_owner() if owner is None else owner
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.started = 0
+        self.resumed = 0
+        self.checkpoints = 0
+    
+    def _find(self, template_name, version):
+        conn = self.ledger.connect()
+        with conn:
+            # A run for an older version of the template will never be resumed.
+            stale = [row[0] for row in conn.execute(
+                "SELECT run_id FROM campaign_runs WHERE template = ? AND version != ? AND owner = ? "
+                "AND status = 'running'",
+                (template_name, version, self.owner)
+            )]
+            for run_id in stale:
+                self._finish(run_id, 'superseded', None)
+        row = conn.execute(
+            "SELECT run_id, cursor, total FROM campaign_runs WHERE template = ? AND version = ? AND owner = ? "
+            "AND status = 'running' ORDER BY started_at DESC LIMIT 1",
+            (template_name, version, self.owner)
+        ).fetchone()
+        if row is None:
+            return None, []
+        run_id, cursor, total = row
+        audience = conn.execute(
+            'SELECT position, user_id, guild_id FROM campaign_audience '
+            'WHERE run_id = ? AND position >= ? ORDER BY position',
+            (run_id, cursor)
+        ).fetchall()
+        return CampaignRun(run_id, template_name, version, cursor, total), audience
+    
+    def _create(self, run, audience):
+        conn = self.ledger.connect()
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT INTO campaign_runs (run_id, template, version, status, cursor, total, started_at, updated_at, owner) "
+                "VALUES (?, ?, ?, 'running', 0, ?, ?, ?, ?)",
+                (run.run_id, run.template_name, run.version, run.total, now, now, self.owner)
+            )
+            conn.executemany(
+                'INSERT INTO campaign_audience (run_id, position, user_id, guild_id) VALUES (?, ?, ?, ?)',
+                ((run.run_id, *row) for row in audience)
+            )
+    
+    def _checkpoint(self, run_id, cursor):
+        conn = self.ledger.connect()
+        with conn:
+            conn.execute('UPDATE campaign_runs SET cursor = ?, updated_at = ? WHERE run_id = ?',
+                         (cursor, time.time(), run_id))
+    
+    def _finish(self, run_id, status, cursor):
+        conn = self.ledger.connect()
+        with conn:
+            conn.execute('UPDATE campaign_runs SET status = ?, cursor = COALESCE(?, cursor), updated_at = ? '
+                         'WHERE run_id = ?', (status, cursor, time.time(), run_id))
+            conn.execute('DELETE FROM campaign_audience WHERE run_id = ?', (run_id,))
+    
+    async def resume(self, template_name, version):
+        run, audience = await self.ledger.run(self._find, template_name, version)
+        if run is not None:
+            self.resumed += 1
+        return run, audience
+    
+    async def start(self, template_name, version, audience):
+        # audience is a list of (user_id, guild_id), already in a stable order
+        run = CampaignRun(uuid.uuid4().hex, template_name, version, 0, len(audience))
+        audience = [(position, user_id, guild_id) for position, (user_id, guild_id) in enumerate(audience)]
+        await self.ledger.run(self._create, run, audience)
+        self.started += 1
+        return run, audience
+    
+    async def checkpoint(self, run):
+        run.since_checkpoint = 0
+        # Deliveries are flushed first so the ledger is never behind the cursor.
+        await self.ledger.flush()
+        await self.ledger.run(self._checkpoint, run.run_id, run.cursor)
+        self.checkpoints += 1
+    
+    async def maybe_checkpoint(self, run):
+        if run.since_checkpoint >= self.checkpoint_every:
+            await self.checkpoint(run)
+    
+    async def finish(self, run, status):
+        await self.ledger.flush()
+        await self.ledger.run(self._finish, run.run_id, status, run.cursor)
+
+TEMPLATE_PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+USER_TEMPLATE_FIELDS = {
+    'username': attrgetter('display_name'),
+    'user_mention': attrgetter('mention'),
+    'user_name': attrgetter('name'),
+    'user_id': lambda user: str(user.id)
+}
+
+class CompiledTemplate:
+    def __init__(self, content):
+        self.literals = []
+        self.placeholders = []
+        position = 0
+        for match in TEMPLATE_PLACEHOLDER.finditer(content):
+            self.literals.append(content[position:match.start()])
+            self.placeholders.append(match.group(1))
+            position = match.end()
+        self.literals.append(content[position:])
+    
+    def bind(self, fields):
+        # Static fields are folded into the surrounding literals; only
+        # per-user fields stay as slots. Unknown placeholders are kept as-is.
+        literals = [self.literals[0]]
+        getters = []
+        for name, literal in zip(self.placeholders, self.literals[1:]):
+            getter = USER_TEMPLATE_FIELDS.get(name)
+            if getter is None:
+                literals[-1] += fields.get(name, '{' + name + '}') + literal
+            else:
+                getters.append(getter)
+                literals.append(literal)
+        return BoundTemplate(literals, getters)
+
+class BoundTemplate:
+    def __init__(self, literals, getters):
+        self.head = literals[0]
+        self.slots = list(zip(getters, literals[1:]))
+    
+    def render(self, user):
+        if not self.slots:
+            return self.head
+        parts = [self.head]
+        for getter, literal in self.slots:
+            parts.append(getter(user))
+            parts.append(literal)
+        return ''.join(parts)
+
+class TemplateEngine:
+    def __init__(self):
+        self.compiled = {}
+        self.bound = {}
+    
+    def reset(self):
+        self.compiled.clear()
+        self.bound.clear()
+    
+    def compile(self, content):
+        compiled = self.compiled.get(content)
+        if compiled is None:
+            compiled = self.compiled[content] = CompiledTemplate(content)
+        return compiled
+    
+    def bind(self, content, guild, affiliate_id, campaign_name=''):
+        # The name is part of the key so a renamed server is picked up right away
+        key = (content, guild.id if guild else None, guild.name if guild else None, affiliate_id, campaign_name)
+        bound = self.bound.get(key)
+        if bound is None:
+            bound = self.bound[key] = self.compile(content).bind({
+                'affiliate_id': str(affiliate_id),
+                'server_name': guild.name if guild else 'Unknown Server',
+                'server_id': str(guild.id) if guild else '',
+                'campaign_name': campaign_name
+            })
+        return bound
+    
+    def render(self, content, user, affiliate_id, campaign_name=''):
+        return self.bind(content, getattr(user, 'guild', None), affiliate_id, campaign_name).render(user)
+
+class CampaignButtons:
+    def __init__(self, api_base_url, template, affiliate_id, original_url):
+        encoded_url = urllib.parse.quote(original_url)
+        self.labels = list(template.get('button_labels', []))
+        self.url_prefix = f'{api_base_url}/functions/trackLinkClick?code={affiliate_id}_{template["name"]}_'
+        self.url_suffix = f'&redirect={encoded_url}'
+        self.second = None
+        self.cached_view = None
+    
+    def buttons(self, second):
+        url = f'{self.url_prefix}{second}{self.url_suffix}'
+        return [{'label': label, 'url': url, 'style': 'primary'} for label in self.labels]
+    
+    def view(self):
+        # Tracking codes carry a per-second timestamp, so one link-only view
+        # is shared by every recipient messaged within the same second.
+        if not self.labels:
+            return None
+        second = int(time.time())
+        if second != self.second:
+            self.cached_view = create_button_view(self.buttons(second))
+            self.second = second
+        return self.cached_view
+
+_MASK64 = (1 << 64) - 1
+
+def _mix64(value):
+    # splitmix64 finalizer: a fixed hash, unlike hash(), which is salted per process
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+class Experiment:
+    def __init__(self, name, ab_tests, salt=None, max_cached=DM_USER_CACHE_SIZE):
+        self.name = name
+        self.ab_tests = ab_tests
+        self.salt = salt
+        self.variants = []
+        weights = []
+        for index, variant in enumerate(ab_tests if isinstance(ab_tests, list) else []):
+            if isinstance(variant, dict):
+                self.variants.append(str(variant.get('name', chr(ord('A') + index))))
+                weights.append(max(0.0, float(variant.get('weight', 1))))
+            elif isinstance(variant, str):
+                self.variants.append(variant)
+                weights.append(1.0)
+        if not self.variants or not sum(weights):
+            # Older configs only switch A/B testing on; keep the two even variants
+            self.variants, weights = ['A', 'B'], [1.0, 1.0]
+        # Users land on a 53-bit point; variant i owns the points below thresholds[i]
+        total = sum(weights)
+        self.thresholds = []
+        running = 0.0
+        for weight in weights[:-1]:
+            running += weight
+            self.thresholds.append(int(running / total * (1 << 53)))
+        self.seed = int.from_bytes(hashlib.sha256(str(salt or name).encode('utf-8')).digest()[:8], 'big')
+        self.max_cached = max_cached
+        self.assignments = {}
+    
+    def _user_key(self, user_id):
+        try:
+            return int(user_id) & _MASK64
+        except (TypeError, ValueError):
+            return int.from_bytes(hashlib.sha256(str(user_id).encode('utf-8')).digest()[:8], 'big')
+    
+    def _cache(self, user_id, variant):
+        if len(self.assignments) >= self.max_cached:
+            self.assignments.clear()
+        self.assignments[user_id] = variant
+    
+    def assign(self, user_id):
+        variant = self.assignments.get(user_id)
+        if variant is None:
+            point = _mix64(self._user_key(user_id) ^ self.seed) >> 11
+            variant = self.variants[bisect_right(self.thresholds, point)]
+            self._cache(user_id, variant)
+        return variant
+    
+    def assign_batch(self, user_ids):
+        user_ids = [user_id for user_id in user_ids if user_id not in self.assignments]
+        if numpy is None or len(user_ids) < 64:
+            for user_id in user_ids:
+                self.assign(user_id)
+            return len(user_ids)
+        keys = numpy.fromiter((self._user_key(user_id) for user_id in user_ids), dtype=numpy.uint64, count=len(user_ids))
+        # Same arithmetic as _mix64; uint64 array operations wrap mod 2**64
+        values = keys ^ numpy.uint64(self.seed)
+        values = values + numpy.uint64(0x9E3779B97F4A7C15)
+        values = (values ^ (values >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        values = values ^ (values >> numpy.uint64(31))
+        points = values >> numpy.uint64(11)
+        indexes = numpy.searchsorted(numpy.array(self.thresholds, dtype=numpy.uint64), points, side='right')
+        for user_id, index in zip(user_ids, indexes.tolist()):
+            self._cache(user_id, self.variants[index])
+        return len(user_ids)
+
+class VariantAssigner:
+    def __init__(self):
+        self.experiments = {}
+    
+    def experiment(self, template):
+        ab_tests = template.get('ab_tests')
+        if not ab_tests:
+            return None
+        name = str(template.get('experiment', template.get('name', 'unnamed')))
+        experiment = self.experiments.get(name)
+        salt = template.get('experiment_salt')
+        # Changing the variants or the salt starts a fresh experiment and cache
+        if experiment is None or experiment.ab_tests != ab_tests or experiment.salt != salt:
+            experiment = Experiment(name, ab_tests, salt)
+            self.experiments[name] = experiment
+        return experiment
+    
+    def assign(self, user_id, template):
+        experiment = self.experiment(template)
+        return experiment.assign(user_id) if experiment is not None else None
+    
+    def assign_batch(self, user_ids, template):
+        experiment = self.experiment(template)
+        return experiment.assign_batch(user_ids) if experiment is not None else 0
 
 class AffiliateBot:
     def __init__(self, bot_token, api_base_url, bot_id):
@@ -91,36 +2335,133 @@ class AffiliateBot:
         self.bot_id = bot_id
         self.rate_limiter = BotRateLimiter()
         self.base44_client = Base44Client(api_base_url)
+        self.spool = Base44Spool(self.base44_client, bot_id)
+        self.activity_shipper = ActivityShipper(self.base44_client, bot_id, spool=self.spool)
+        self.role_index = RoleIndex()
+        self.dispatcher = CampaignDispatcher(max_concurrency=CAMPAIGN_MAX_CONCURRENCY if ADAPTIVE_RATE else None)
+        self.delivery_ledger = DeliveryLedger()
+        self.campaign_runs = CampaignRunStore(self.delivery_ledger)
+        self.undeliverable = UndeliverableCache(self.delivery_ledger)
+        self.rate_limiter.on_undeliverable = self.undeliverable.add
+        self.dm_channels = DMChannelCache(self.delivery_ledger)
+        self.rate_limiter.dm_channels = self.dm_channels
+        self.send_stats = RollingStats()
+        self.rate_limiter.send_stats = self.send_stats
+        self.send_controller = None
+        if ADAPTIVE_RATE:
+            self.send_controller = SendRateController(self.rate_limiter, self.dispatcher)
+            self.rate_limiter.controller = self.send_controller
+            logging.getLogger('discord.http').addHandler(RateLimitLogHandler(self.send_controller))
+        self.template_engine = TemplateEngine()
+        self.link_index = {}
+        self.campaign_buttons = {}
+        self.realtime_queue = RealtimeQueue(self.deliver_realtime)
+        self.scheduler = CampaignScheduler()
+        self.audiences = ExpiringCache(8, AUDIENCE_CACHE_TTL)
+        self.variants = VariantAssigner()
+        self.main_task = None
+        self.config_refresh = None
+        self.chunk_tasks = {}
+        self.register_metrics()
         self.current_config = None
+        self.config_hash = None
+        self.config_version = 0
+        self.section_hashes = {}
+        self.enabled_role_ids = frozenset()
         
     async def get_bot_config(self):
+        if self.current_config is None:
+            # Warm start: with getBotConfig retries a slow or down Base44 could
+            # hold up the first campaign for a minute, so start from the cache
+            cached = self.load_cached_config()
+            if cached is not None:
+                log.info('Using cached config from %s while fetching the latest', CONFIG_CACHE_PATH)
+                config = self.apply_config(cached, persist=False)
+                self.config_refresh = asyncio.ensure_future(self.refresh_config())
+                return config
+        return await self.fetch_bot_config()
+    
+    async def refresh_config(self):
+        version = self.config_version
+        config = await self.fetch_bot_config()
+        if self.config_version != version and config.get('active', False):
+            self.scheduler.update(config)
+        return config
+    
+    async def fetch_bot_config(self):
         try:
             config = await self.base44_client.get_bot_config(self.bot_id, self.bot_token)
             if config and config.get('success'):
-                self.current_config = config.get('data', {})
-                return self.current_config
-            else:
-                print(' Failed to get bot config from Base44 platform - using default config')
-                # Return a default configuration if Base44 is not available
-                self.current_config = {
-                    'active': True,
-                    'affiliate_id': 'default_affiliate',
-                    'message_templates': [],
-                    'target_roles': [],
-                    'affiliate_links': []
-                }
-                return self.current_config
+                return self.apply_config(config.get('data', {}))
+            log.warning('Failed to get bot config from Base44 platform - using last known config')
         except Exception as e:
-            print(f' Error getting bot config: {e} - using default config')
-            # Return a default configuration if there's an error
-            self.current_config = {
-                'active': True,
-                'affiliate_id': 'default_affiliate',
-                'message_templates': [],
-                'target_roles': [],
-                'affiliate_links': []
-            }
+            log.error('Error getting bot config: %s - using last known config', e)
+        return self.fallback_config()
+    
+    def fallback_config(self):
+        if self.current_config is not None:
+            return self.current_config
+        cached = self.load_cached_config()
+        if cached is not None:
+            log.info('Using cached config from %s', CONFIG_CACHE_PATH)
+            return self.apply_config(cached, persist=False)
+        log.warning('No cached config available - using default config')
+        return self.apply_config({
+            'active': True,
+            'affiliate_id': 'default_affiliate',
+            'message_templates': [],
+            'target_roles': [],
+            'affiliate_links': []
+        }, persist=False)
+    
+    def apply_config(self, config, persist=True):
+        digest = config_hash(config)
+        if self.current_config is not None and digest == self.config_hash:
             return self.current_config
+        section_hashes = {section: config_hash(config.get(section)) for section in CONFIG_SECTIONS}
+        changed = {section for section, section_hash in section_hashes.items()
+                   if self.section_hashes.get(section) != section_hash}
+        self.current_config = config
+        self.config_hash = digest
+        self.section_hashes = section_hashes
+        self.config_version += 1
+        if 'message_templates' in changed:
+            self.template_engine.reset()
+        if 'affiliate_links' in changed:
+            self.link_index = {}
+            for link in config.get('affiliate_links', []):
+                self.link_index.setdefault(link['name'], link['url_template'])
+        if changed & {'message_templates', 'affiliate_links'}:
+            self.campaign_buttons = {}
+        if 'target_roles' in changed:
+            self.enabled_role_ids = frozenset(
+                str(role['role_id']) for role in config.get('target_roles', []) if role.get('enabled'))
+        if 'settings' in changed:
+            self.rate_limiter.configure(config.get('settings') or {})
+        if persist:
+            self.save_cached_config(config, digest)
+        log.info('Loaded config version %s%s', self.config_version,
+                 f' ({", ".join(sorted(changed))} changed)' if changed else '')
+        return self.current_config
+    
+    def load_cached_config(self):
+        try:
+            with open(CONFIG_CACHE_PATH, 'r', encoding='utf-8') as f:
+                return json.load(f)['config']
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.error('Error reading cached config: %s', e)
+            return None
+    
+    def save_cached_config(self, config, digest):
+        try:
+            tmp_path = f'{CONFIG_CACHE_PATH}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'hash': digest, 'saved_at': time.time(), 'config': config}, f)
+            os.replace(tmp_path, CONFIG_CACHE_PATH)
+        except Exception as e:
+            log.error('Error caching config: %s', e)
     
     async def log_bot_activity(self, activity_type, **kwargs):
         try:
@@ -130,144 +2471,428 @@ class AffiliateBot:
                 'timestamp': datetime.utcnow().isoformat() + 'Z',
                 **kwargs
             }
-            result = await self.base44_client.log_bot_activity(activity_data)
-            if result and result.get('success'):
-                print(f' Logged activity: {activity_type}')
-            else:
-                print(f' Failed to log activity: {activity_type}')
+            if not self.activity_shipper.enqueue(activity_data):
+                log.warning('Activity queue full, dropped activity: %s', activity_type, extra={'event': 'activity_dropped'})
         except Exception as e:
-            print(f' Error logging activity: {e}')
+            log.error('Error logging activity: %s', e)
     
     async def update_bot_status(self, status, message=None, stats=None):
+        status_data = {
+            'bot_id': self.bot_id,
+            'status': status,
+            'message': message,
+            'stats': stats or {}
+        }
         try:
-            status_data = {
-                'bot_id': self.bot_id,
-                'status': status,
-                'message': message,
-                'stats': stats or {}
-            }
             result = await self.base44_client.update_bot_status(status_data)
             if result and result.get('success'):
-                print(f' Updated bot status: {status}')
-            else:
-                print(f' Failed to update status: {status}')
+                log.info('Updated bot status: %s', status)
+                self.spool.status_delivered()
+                return
+            log.warning('Failed to update status: %s', status)
         except Exception as e:
-            print(f' Error updating status: {e}')
+            log.error('Error updating status: %s', e)
+        self.spool.add('status', status_data)
     
     def process_message_template(self, template, user, affiliate_id):
-        content = template['content']
-        content = content.replace('{username}', user.display_name)
-        content = content.replace('{user_mention}', user.mention)
-        content = content.replace('{affiliate_id}', str(affiliate_id))
-        content = content.replace('{server_name}', user.guild.name if user.guild else 'Unknown Server')
+        started = time.perf_counter()
+        content = self.template_engine.render(template['content'], user, affiliate_id, template.get('name', ''))
+        TEMPLATE_RENDER_SECONDS.observe(time.perf_counter() - started)
         return content
     
+    def build_role_index(self, guilds):
+        started = time.perf_counter()
+        member_count = 0
+        for guild in guilds:
+            self.role_index.index_guild(guild)
+            member_count += len(guild.members)
+        log.info('Indexed roles for %s members in %.2fs', member_count, time.perf_counter() - started)
+    
+    def get_enabled_role_ids(self, target_roles):
+        if self.current_config is not None and target_roles is self.current_config.get('target_roles'):
+            return self.enabled_role_ids
+        return {str(role['role_id']) for role in target_roles if role['enabled']}
+    
+    async def _chunk_guild(self, guild):
+        try:
+            started = time.perf_counter()
+            await guild.chunk(cache=True)
+            self.role_index.index_guild(guild)
+            log.info('Loaded %s members of %s in %.1fs', len(guild.members), guild.name, time.perf_counter() - started)
+        finally:
+            self.chunk_tasks.pop(guild.id, None)
+    
+    async def ensure_guild_members(self, guild):
+        if guild.chunked:
+            return
+        task = self.chunk_tasks.get(guild.id)
+        if task is None:
+            task = self.chunk_tasks[guild.id] = asyncio.ensure_future(self._chunk_guild(guild))
+        await task
+    
     async def get_users_by_roles(self, guild, target_roles):
-        valid_users = []
-        enabled_role_ids = [role['role_id'] for role in target_roles if role['enabled']]
-        for member in guild.members:
-            if any(str(role.id) in enabled_role_ids for role in member.roles):
-                valid_users.append(member)
-        return valid_users
+        enabled_role_ids = self.get_enabled_role_ids(target_roles)
+        if not enabled_role_ids:
+            return []
+        if not guild.chunked:
+            await self.ensure_guild_members(guild)
+        elif not self.role_index.is_indexed(guild):
+            self.role_index.index_guild(guild)
+        return self.role_index.members_with_roles(guild, enabled_role_ids)
     
-    def select_message_variant(self, user_id, ab_tests):
-        if not ab_tests:
-            return None
-        user_hash = hash(user_id) % 2
-        return 'A' if user_hash == 0 else 'B'
+    async def _build_audience(self, target_roles):
+        started = time.perf_counter()
+        audience = {}
+        guilds = discord_bot.guilds
+        for guild in guilds:
+            for user in await self.get_users_by_roles(guild, target_roles):
+                # A user in several target guilds is messaged once, via the first
+                audience.setdefault(str(user.id), user)
+        elapsed = time.perf_counter() - started
+        AUDIENCE_BUILD_SECONDS.observe(elapsed)
+        log.info('Found %s target users across %s guilds in %.2fs', len(audience), len(guilds), elapsed)
+        return audience
+    
+    async def build_audience(self, target_roles):
+        # One audience per cycle: every template that runs within
+        # AUDIENCE_CACHE_TTL shares it, including one still being built.
+        key = frozenset(self.get_enabled_role_ids(target_roles))
+        build = self.audiences.get(key)
+        if build is None or (build.done() and (build.cancelled() or build.exception() is not None)):
+            build = asyncio.ensure_future(self._build_audience(target_roles))
+            self.audiences.set(key, build)
+            build.add_done_callback(lambda task: self._audience_built(key, task))
+        # Shared between templates; callers must not modify it
+        return await asyncio.shield(build)
+    
+    def _audience_built(self, key, build):
+        # The TTL counts from when the audience was ready, not when the build started
+        if not build.cancelled() and build.exception() is None:
+            self.audiences.set(key, build)
+    
+    def select_message_variant(self, user_id, template):
+        return self.variants.assign(user_id, template)
     
     def create_trackable_link(self, original_url, affiliate_id, campaign_id):
         tracking_code = f'{affiliate_id}_{campaign_id}_{int(time.time())}'
         encoded_url = urllib.parse.quote(original_url)
         return f'{self.api_base_url}/functions/trackLinkClick?code={tracking_code}&redirect={encoded_url}'
     
+    def get_link_url(self, link_name, config):
+        if config is self.current_config:
+            return self.link_index.get(link_name, '#')
+        return next(
+            (link['url_template'] for link in config.get('affiliate_links', []) 
+             if link['name'] == link_name), 
+            '#'
+        )
+    
+    def get_campaign_buttons(self, template, config):
+        affiliate_id = config.get('affiliate_id', 'default')
+        link_name = template.get('selected_link_name', 'main_affiliate_link')
+        key = (template['name'], affiliate_id, link_name, tuple(template.get('button_labels', [])))
+        campaign_buttons = self.campaign_buttons.get(key)
+        if campaign_buttons is None or config is not self.current_config:
+            campaign_buttons = CampaignButtons(
+                self.api_base_url, template, affiliate_id, self.get_link_url(link_name, config))
+            if config is self.current_config:
+                self.campaign_buttons[key] = campaign_buttons
+        return campaign_buttons
+    
+    async def send_campaign_message(self, user, template, config):
+        try:
+            variant = self.select_message_variant(str(user.id), template)
+            content = self.process_message_template(template, user, config.get('affiliate_id', 'default'))
+            view = None
+            if template.get('has_buttons', False):
+                view = self.get_campaign_buttons(template, config).view()
+            success, error = await self.rate_limiter.send_dm_safely(user, content, view=view)
+            self.send_stats.record_message(template.get('name', 'unnamed'), variant, success)
+            await self.log_bot_activity('message_sent',
+                user_id=str(user.id),
+                message_sent=content,
+                role_targeted=config.get('target_roles', [{}])[0].get('role_name', 'Unknown') 
+                if config.get('target_roles') else 'Unknown',
+                success=success,
+                error_message=error if not success else None,
+                variant=variant
+            )
+            if success:
+                log.info('Sent DM to %s', user.display_name, extra={'event': 'dm_sent', 'user_id': user.id})
+            else:
+                log.info('Failed to send DM to %s: %s', user.display_name, error,
+                         extra={'event': 'dm_failed', 'user_id': user.id})
+            return success
+        except Exception as e:
+            log.error('Error processing user %s: %s', user.display_name, e, extra={'event': 'dm_error', 'user_id': user.id})
+            await self.log_bot_activity('error',
+                error_message=str(e),
+                success=False
+            )
+            return False
+    
+    def get_resend_hours(self, template, config):
+        return float(template.get('resend_after_hours',
+            (config.get('settings') or {}).get('resend_after_hours', DELIVERY_RESEND_HOURS)))
+    
+    async def deliver_campaign_message(self, user, template, config, version):
+        campaign_name = template.get('name', 'unnamed')
+        user_id = str(user.id)
+        if self.delivery_ledger.recently_recorded(user_id, campaign_name, version):
+            return None
+        if self.undeliverable.hit(user_id):
+            return None
+        resend_hours = self.get_resend_hours(template, config)
+        if not await self.delivery_ledger.claim(user_id, campaign_name, version, resend_hours):
+            return None
+        success = False
+        try:
+            success = await self.send_campaign_message(user, template, config)
+        finally:
+            if success:
+                await self.delivery_ledger.record(user_id, campaign_name, version)
+            else:
+                await self.delivery_ledger.release(user_id, campaign_name, version)
+        return success
+    
+    def queue_realtime_targets(self, member, gained_role_ids):
+        config = self.current_config
+        if not config or not config.get('active', False):
+            return 0
+        if not self.get_enabled_role_ids(config.get('target_roles', [])) & set(gained_role_ids):
+            return 0
+        queued = 0
+        for template in config.get('message_templates', []):
+            campaign_name = template.get('name', 'unnamed')
+            if self.realtime_queue.enqueue((member.id, campaign_name), member, campaign_name):
+                queued += 1
+        if queued:
+            log.info('Queued %s for %s templates', member.display_name, queued, extra={'event': 'realtime_queued'})
+        return queued
+    
+    async def deliver_realtime(self, member, campaign_name):
+        config = self.current_config
+        if not config or not config.get('active', False):
+            return
+        template = next((t for t in config.get('message_templates', []) if t.get('name', 'unnamed') == campaign_name), None)
+        if template is None:
+            return
+        version = self.delivery_ledger.campaign_version(template)
+        await self.undeliverable.load()
+        await self.dm_channels.load()
+        delivered = await self.delivery_ledger.delivered_user_ids(
+            [str(member.id)], campaign_name, version, self.get_resend_hours(template, config))
+        if delivered:
+            return
+        await self.deliver_campaign_message(member, template, config, version)
+        await self.delivery_ledger.flush()
+        await self.undeliverable.flush()
+        await self.dm_channels.flush()
+    
+    def cancel_campaign(self, campaign_name):
+        return self.dispatcher.cancel(campaign_name)
+    
     async def process_campaign(self, template, config):
         try:
-            target_users = []
-            for guild in discord_bot.guilds:
-                users = await self.get_users_by_roles(guild, config.get('target_roles', []))
-                target_users.extend(users)
-            print(f' Found {len(target_users)} target users')
-            for user in target_users:
+            campaign_name = template.get('name', 'unnamed')
+            version = self.delivery_ledger.campaign_version(template)
+            resend_hours = self.get_resend_hours(template, config)
+            guilds = {str(guild.id): guild for guild in discord_bot.guilds}
+            members = {}
+            await self.undeliverable.load()
+            await self.dm_channels.load()
+            run, audience = await self.campaign_runs.resume(campaign_name, version)
+            if run is None:
+                members = await self.build_audience(config.get('target_roles', []))
+                undeliverable = self.undeliverable.filter(members.keys())
+                if undeliverable:
+                    log.info('Skipping %s users who cannot receive DMs', len(undeliverable))
+                delivered = await self.delivery_ledger.delivered_user_ids(
+                    list(members.keys() - undeliverable), campaign_name, version, resend_hours)
+                if delivered:
+                    log.info('Skipping %s users already messaged for %s', len(delivered), campaign_name)
+                # Sorted by user ID so the snapshot, and a cursor into it, stay stable across restarts
+                snapshot = sorted(
+                    ((user_id, str(members[user_id].guild.id)) for user_id in members.keys() - delivered - undeliverable),
+                    key=lambda row: int(row[0])
+                )
+                run, audience = await self.campaign_runs.start(campaign_name, version, snapshot)
+                if DM_PREWARM_LIMIT > 0:
+                    await self.dm_channels.prewarm((members[row[1]] for row in audience), self.rate_limiter)
+                delivered = set()
+            else:
+                log.info('Resuming campaign run %s for %s at %s/%s', run.run_id, campaign_name, run.cursor, run.total)
+                # After a restart (or with LEAN_GATEWAY) members are not cached yet
+                for guild_id in {row[2] for row in audience}:
+                    if guild_id in guilds:
+                        await self.ensure_guild_members(guilds[guild_id])
+                # Sends after the last checkpoint are already in the ledger
+                delivered = await self.delivery_ledger.delivered_user_ids(
+                    [row[1] for row in audience], campaign_name, version, resend_hours)
+            self.variants.assign_batch([row[1] for row in audience], template)
+            positions = {}
+            unresolved = []
+            
+            def targets():
+                for position, user_id, guild_id in audience:
+                    if user_id in delivered:
+                        run.complete(position)
+                        continue
+                    user = members.get(user_id)
+                    if user is None:
+                        guild = guilds.get(guild_id)
+                        user = guild.get_member(int(user_id)) if guild is not None else None
+                    if user is None:
+                        # Not found is not the same as done: leave the position open
+                        unresolved.append(position)
+                        continue
+                    positions[user.id] = position
+                    yield user
+            
+            async def deliver(user):
+                position = positions.pop(user.id)
                 try:
-                    variant = self.select_message_variant(str(user.id), template.get('ab_tests', []))
-                    content = self.process_message_template(template, user, config.get('affiliate_id', 'default'))
-                    buttons = None
-                    if template.get('has_buttons', False):
-                        buttons = []
-                        for label in template.get('button_labels', []):
-                            link_name = template.get('selected_link_name', 'main_affiliate_link')
-                            original_url = next(
-                                (link['url_template'] for link in config.get('affiliate_links', []) 
-                                 if link['name'] == link_name), 
-                                '#'
-                            )
-                            trackable_url = self.create_trackable_link(
-                                original_url, 
-                                config.get('affiliate_id', 'default'), 
-                                template['name']
-                            )
-                            buttons.append({
-                                'label': label,
-                                'url': trackable_url,
-                                'style': 'primary'
-                            })
-                    success, error = await self.rate_limiter.send_dm_safely(user, content, buttons)
-                    await self.log_bot_activity('message_sent',
-                        user_id=str(user.id),
-                        message_sent=content,
-                        role_targeted=config.get('target_roles', [{}])[0].get('role_name', 'Unknown') 
-                        if config.get('target_roles') else 'Unknown',
-                        success=success,
-                        error_message=error if not success else None,
-                        variant=variant
-                    )
-                    if success:
-                        print(f' Sent DM to {user.display_name}')
-                    else:
-                        print(f' Failed to send DM to {user.display_name}: {error}')
-                except Exception as e:
-                    print(f' Error processing user {user.display_name}: {e}')
-                    await self.log_bot_activity('error',
-                        error_message=str(e),
-                        success=False
-                    )
+                    success = await self.deliver_campaign_message(user, template, config, version)
+                except asyncio.CancelledError:
+                    # Interrupted mid-send: leave the position open so a resume retries it
+                    raise
+                except Exception:
+                    run.complete(position)
+                    raise
+                run.complete(position)
+                await self.campaign_runs.maybe_checkpoint(run)
+                return success
+            
+            finished = False
+            try:
+                stats = await self.dispatcher.run(campaign_name, targets(), deliver)
+                stats['run_id'] = run.run_id
+                if stats['cancelled']:
+                    status = 'cancelled'
+                elif unresolved:
+                    status = 'unresolved'
+                else:
+                    status = 'completed'
+                await self.campaign_runs.finish(run, status)
+                finished = True
+            finally:
+                if not finished:
+                    # Interrupted (shutdown or error): keep the run open for the next start
+                    await self.campaign_runs.checkpoint(run)
+                await self.undeliverable.flush()
+                await self.dm_channels.flush()
+            if status == 'unresolved':
+                # Only a resumed snapshot can go stale; a fresh audience picks up
+                # whoever is still a member and is not in the ledger yet.
+                log.warning('%s users of run %s for %s could not be found, rebuilding its audience',
+                            len(unresolved), run.run_id, campaign_name)
+                fresh = await self.process_campaign(template, config)
+                if fresh:
+                    for key in ('sent', 'failed', 'skipped', 'errors'):
+                        fresh[key] += stats[key]
+                    return fresh
+            return stats
         except Exception as e:
-            print(f' Error processing campaign: {e}')
+            log.error('Error processing campaign: %s', e)
             await self.log_bot_activity('error',
                 error_message=str(e),
                 success=False
             )
     
     async def main_loop(self):
+        # Role gains are handled in real time; scheduled runs only reconcile
+        # what events missed (downtime, config changes), each template on its
+        # own cadence. The loop sleeps until the next template is due.
+        next_refresh = 0
+        config = None
+        # Replays whatever a previous run could not hand to Base44
+        self.spool.start()
         while True:
             try:
-                config = await self.get_bot_config()
-                if not config.get('active', False):
-                    print(' Bot is paused, waiting...')
-                    await asyncio.sleep(60)
-                    continue
-                print(' Processing bot configuration from Base44 platform...')
-                templates = config.get('message_templates', [])
-                if templates:
-                    for template in templates:
-                        await self.process_campaign(template, config)
-                    print(f' Processed {len(templates)} message templates')
-                else:
-                    print(' No message templates configured yet - bot is ready and waiting')
-                
-                await self.update_bot_status('active', 'Bot running smoothly', {
-                    'messages_sent': len(templates),
-                    'templates_configured': len(templates)
-                })
-                print(' Waiting 5 minutes before next cycle...')
-                await asyncio.sleep(300)
+                if time.monotonic() >= next_refresh:
+                    config = await self.get_bot_config()
+                    next_refresh = time.monotonic() + CONFIG_REFRESH_INTERVAL
+                    if not config.get('active', False):
+                        log.info('Bot is paused, waiting...')
+                        next_refresh = time.monotonic() + 60
+                    else:
+                        self.scheduler.update(config)
+                        if not config.get('message_templates'):
+                            log.info('No message templates configured yet - bot is ready and waiting')
+                        await self.update_bot_status('active', 'Bot running smoothly', {
+                            'messages_sent': DMS_TOTAL.total(result='sent'),
+                            'templates_configured': len(config.get('message_templates', [])),
+                            'schedule': self.scheduler.schedule(),
+                            'delivery': self.send_stats.snapshot(),
+                            'spool': self.spool.stats(),
+                            'base44': self.base44_client.stats(),
+                            'rate_limits': self.rate_limiter.stats(),
+                            'dm_channels': self.dm_channels.stats(),
+                            **self.runtime_stats()
+                        })
+                # A background refresh may have replaced the config since
+                active = (self.current_config or config).get('active', False)
+                if active:
+                    started = self.scheduler.start_due(
+                        lambda template: self.process_campaign(template, self.current_config or config))
+                    if started:
+                        log.info('Started campaigns: %s', ', '.join(started))
+                await self.scheduler.wait(next_refresh, active)
             except Exception as e:
-                print(f' Error in main loop: {e}')
+                log.error('Error in main loop: %s', e)
                 await self.log_bot_activity('error', error_message=str(e), success=False)
                 await asyncio.sleep(60)
     
+    def register_metrics(self):
+        metrics.gauge('affiliate_bot_activity_queue_depth', 'Activities waiting to be shipped to Base44',
+                      lambda: self.activity_shipper.stats()['queue_depth'])
+        metrics.gauge('affiliate_bot_activities_dropped', 'Activities dropped because the queue was full',
+                      lambda: self.activity_shipper.dropped)
+        metrics.gauge('affiliate_bot_realtime_queue_depth', 'Members waiting for a real-time DM',
+                      lambda: self.realtime_queue.stats()['queue_depth'])
+        metrics.gauge('affiliate_bot_ledger_pending', 'Deliveries not yet written to the ledger',
+                      lambda: len(self.delivery_ledger.pending))
+        metrics.gauge('affiliate_bot_ledger_claimed_elsewhere', 'Sends skipped because another worker claimed the user first',
+                      lambda: self.delivery_ledger.claimed_elsewhere)
+        metrics.gauge('affiliate_bot_spool_depth', 'Base44 writes waiting in the spool',
+                      lambda: self.spool.depth + len(self.spool.pending))
+        metrics.gauge('affiliate_bot_spool_backlog_age_seconds', 'Age of the oldest spooled Base44 write',
+                      self.spool.backlog_age)
+        metrics.gauge('affiliate_bot_undeliverable_users', 'Users currently known to be undeliverable',
+                      lambda: len(self.undeliverable.entries))
+        metrics.gauge('affiliate_bot_active_campaigns', 'Campaigns currently dispatching',
+                      lambda: len(self.dispatcher.active_runs))
+        metrics.gauge('affiliate_bot_base44_breaker_open', '1 while the Base44 circuit breaker is open',
+                      lambda: 0 if self.base44_client.breaker.state == 'closed' else 1)
+        metrics.gauge('affiliate_bot_config_version', 'Config versions loaded since startup',
+                      lambda: self.config_version)
+    
+    def runtime_stats(self):
+        return {
+            'worker_id': WORKER_ID,
+            'shard_ids': list(discord_bot.shard_ids) if getattr(discord_bot, 'shard_ids', None) else None,
+            'shard_count': discord_bot.shard_count,
+            'guilds': len(discord_bot.guilds),
+            'members': sum(guild.member_count or 0 for guild in discord_bot.guilds)
+        }
+    
     async def close(self):
+        if self.main_task is not None and not self.main_task.done():
+            # Let an in-flight campaign write its checkpoint before the ledger closes
+            self.main_task.cancel()
+            try:
+                await self.main_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self.config_refresh is not None and not self.config_refresh.done():
+            self.config_refresh.cancel()
+        await self.scheduler.close()
+        await self.realtime_queue.close()
+        await self.activity_shipper.close()
+        await self.spool.close()
+        await self.undeliverable.flush()
+        await self.dm_channels.flush()
+        await self.delivery_ledger.close()
         await self.base44_client.close()
 
 def create_button_view(buttons):
@@ -285,59 +2910,102 @@ affiliate_bot = AffiliateBot(DISCORD_BOT_TOKEN, API_BASE_URL, BOT_ID)
 
 @discord_bot.event
 async def on_ready():
-    print(f' Logged in as {discord_bot.user}')
-    print(f' Bot is in {len(discord_bot.guilds)} server(s)')
-    print(f' Connected to Base44 platform: {API_BASE_URL}')
+    log.info('Logged in as %s', discord_bot.user)
+    log.info('Bot is in %s server(s)', len(discord_bot.guilds))
+    if discord_bot.shard_count:
+        log.info('Shards: %s of %s%s', getattr(discord_bot, 'shard_ids', None) or 'all', discord_bot.shard_count,
+                 f' (worker {WORKER_ID})' if WORKER_ID else '')
+    log.info('Connected to Base44 platform: %s', API_BASE_URL)
     for guild in discord_bot.guilds:
-        print(f'  - {guild.name} (ID: {guild.id})')
+        log.info(' - %s (ID: %s)', guild.name, guild.id)
         permissions = guild.me.guild_permissions
-        print(f'    Permissions: Send Messages: {permissions.send_messages}, Manage Roles: {permissions.manage_roles}')
+        log.info('   Permissions: Send Messages: %s, Manage Roles: %s', permissions.send_messages, permissions.manage_roles)
+    # In lean mode guilds are not chunked yet; they are indexed when first chunked
+    affiliate_bot.build_role_index([guild for guild in discord_bot.guilds if guild.chunked])
     await affiliate_bot.log_bot_activity('startup', success=True)
-    await affiliate_bot.update_bot_status('active', 'Bot started successfully')
-    asyncio.create_task(affiliate_bot.main_loop())
+    await affiliate_bot.update_bot_status('active', 'Bot started successfully', affiliate_bot.runtime_stats())
+    # on_ready fires again after a full reconnect; keep a single main loop
+    if affiliate_bot.main_task is None or affiliate_bot.main_task.done():
+        affiliate_bot.main_task = asyncio.create_task(affiliate_bot.main_loop())
+
+@discord_bot.event
+async def on_member_join(member):
+    affiliate_bot.role_index.add_member(member)
+
+@discord_bot.event
+async def on_member_remove(member):
+    affiliate_bot.role_index.remove_member(member)
+
+@discord_bot.event
+async def on_guild_join(guild):
+    if guild.chunked:
+        affiliate_bot.role_index.index_guild(guild)
+
+@discord_bot.event
+async def on_guild_remove(guild):
+    affiliate_bot.role_index.drop_guild(guild)
+
+@discord_bot.event
+async def on_guild_role_delete(role):
+    affiliate_bot.role_index.drop_role(role)
 
 @discord_bot.event
 async def on_member_update(before, after):
     try:
+        affiliate_bot.role_index.update_member(before, after)
+        gained_role_ids = {str(role.id) for role in after.roles} - {str(role.id) for role in before.roles}
+        if gained_role_ids:
+            affiliate_bot.queue_realtime_targets(after, gained_role_ids)
         if len(after.roles) > len(before.roles):
             new_roles = [role for role in after.roles if role not in before.roles]
             for role in new_roles:
-                print(f' User {after.display_name} gained role: {role.name}')
+                log.info('User %s gained role: %s', after.display_name, role.name, extra={'event': 'role_gained'})
                 await affiliate_bot.log_bot_activity('user_targeted',
                     user_id=str(after.id),
                     role_targeted=role.name,
                     success=True
                 )
     except Exception as e:
-        print(f' Error handling member update: {e}')
+        log.error('Error handling member update: %s', e)
 
 @discord_bot.event
 async def on_error(event, *args, **kwargs):
-    print(f' Bot error in {event}: {args}')
+    log.error('Bot error in %s: %s', event, args, exc_info=True)
     await affiliate_bot.log_bot_activity('error',
         error_message=f'Bot error in {event}: {args}',
         success=False
     )
 
 async def run_bot():
+    metrics_runner = None
     try:
+        try:
+            metrics_runner = await start_metrics_server()
+        except OSError as e:
+            log.warning('Could not start metrics server: %s', e)
         await discord_bot.start(DISCORD_BOT_TOKEN)
     except Exception as e:
-        print(f' Error starting bot: {e}')
+        log.error('Error starting bot: %s', e)
         await affiliate_bot.log_bot_activity('shutdown', success=False)
     finally:
         await affiliate_bot.close()
         await discord_bot.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+async def log_shutdown(success):
+    await affiliate_bot.log_bot_activity('shutdown', success=success)
+    await affiliate_bot.close()
 
 if __name__ == '__main__':
-    print(' Starting Base44 Affiliate Bot...')
-    print(f' Base44 Platform: {API_BASE_URL}')
-    print(f' Bot ID: {BOT_ID}')
+    log.info('Starting Base44 Affiliate Bot...')
+    log.info('Base44 Platform: %s', API_BASE_URL)
+    log.info('Bot ID: %s', BOT_ID)
     try:
         asyncio.run(run_bot())
     except KeyboardInterrupt:
-        print(' Bot stopped by user')
-        asyncio.run(affiliate_bot.log_bot_activity('shutdown', success=True))
+        log.info('Bot stopped by user')
+        asyncio.run(log_shutdown(True))
     except Exception as e:
-        print(f' Fatal error: {e}')
-        asyncio.run(affiliate_bot.log_bot_activity('shutdown', success=False))
+        log.critical('Fatal error: %s', e)
+        asyncio.run(log_shutdown(False))
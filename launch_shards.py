@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Multi-process launcher: spreads the bot's shards across several worker processes
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import requests
+from dotenv import load_dotenv
+
+DISCORD_GATEWAY_URL = 'https://discord.com/api/v10/gateway/bot'
+
+def fetch_recommended_shards(token):
+    """Ask Discord how many shards and identify slots the bot should use"""
+    response = requests.get(DISCORD_GATEWAY_URL, headers={'Authorization': f'Bot {token}'}, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    return data['shards'], data.get('session_start_limit', {}).get('max_concurrency', 1)
+
+def split_shards(shard_count, workers):
+    """Split shard IDs into contiguous, evenly sized ranges, one per worker"""
+    workers = max(1, min(workers, shard_count))
+    base, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for worker_id in range(workers):
+        size = base + (1 if worker_id < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+def env_number(name, default, cast=int):
+    """Read a numeric env var, treating an empty value (as in env_template.txt) as unset"""
+    value = os.getenv(name)
+    return cast(value) if value else default
+
+def start_worker(worker_id, shard_ids, shard_count, worker_count):
+    """Start one bot process that owns the given shards"""
+    env = dict(os.environ)
+    env['WORKER_ID'] = str(worker_id)
+    env['SHARD_COUNT'] = str(shard_count)
+    env['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in shard_ids)
+    # Discord's global request limit is per bot token; each worker divides its
+    # rate (DM_GLOBAL_RATE or the config's global_dm_rate) by this count
+    env['SHARD_WORKERS'] = str(worker_count)
+    # The Base44 spool is replayed and emptied by its owner, so it must not be
+    # shared: two workers would both replay (and duplicate) the same rows
+    spool_root, spool_ext = os.path.splitext(os.getenv('BASE44_SPOOL_PATH') or 'base44_spool.db')
+    env['BASE44_SPOOL_PATH'] = f'{spool_root}_worker{worker_id}{spool_ext}'
+    # One metrics port per worker, counting up from METRICS_PORT
+    metrics_port = env_number('METRICS_PORT', 9108)
+    env['METRICS_PORT'] = str(metrics_port + worker_id if metrics_port else 0)
+    print(f"🚀 Starting worker {worker_id} with shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}")
+    return subprocess.Popen([sys.executable, BOT_PATH], env=env)
+
+def main():
+    """Launch and supervise the worker processes"""
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Run the affiliate bot across several processes')
+    parser.add_argument('--workers', type=int, default=env_number('SHARD_WORKERS', os.cpu_count() or 1),
+                        help='number of worker processes (default: SHARD_WORKERS or CPU count)')
+    parser.add_argument('--shards', type=int, default=env_number('SHARD_COUNT', 0),
+                        help='total shard count (default: SHARD_COUNT or Discord\'s recommendation)')
+    parser.add_argument('--start-delay', type=float, default=env_number('WORKER_START_DELAY', 5.0, float),
+                        help='seconds between worker starts, to respect identify limits')
+    args = parser.parse_args()
+
+    token = os.getenv('DISCORD_BOT_TOKEN')
+    if not token:
+        print("❌ DISCORD_BOT_TOKEN environment variable is required!")
+        sys.exit(1)
+
+    shard_count = args.shards
+    if not shard_count:
+        try:
+            shard_count, max_concurrency = fetch_recommended_shards(token)
+            print(f"✅ Discord recommends {shard_count} shard(s), identify concurrency {max_concurrency}")
+        except Exception as e:
+            print(f"❌ Could not fetch recommended shard count: {e}")
+            sys.exit(1)
+
+    shard_ranges = split_shards(shard_count, args.workers)
+    workers = {}
+    for worker_id, shard_ids in enumerate(shard_ranges):
+        workers[worker_id] = start_worker(worker_id, shard_ids, shard_count, len(shard_ranges))
+        time.sleep(args.start_delay)
+
+    try:
+        while True:
+            time.sleep(5)
+            for worker_id, process in list(workers.items()):
+                code = process.poll()
+                if code is not None:
+                    print(f"⚠️  Worker {worker_id} exited with code {code}, restarting...")
+                    time.sleep(args.start_delay)
+                    workers[worker_id] = start_worker(worker_id, shard_ranges[worker_id], shard_count, len(shard_ranges))
+    except KeyboardInterrupt:
+        print("🛑 Stopping workers...")
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+if __name__ == '__main__':
+    main()
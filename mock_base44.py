@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Base44 functions API
+
+Serves getBotConfig, logBotActivity, updateBotStatus and trackLinkClick with
+injectable latency, errors and throttling, and records every request so
+throughput and batching can be measured offline.
+
+Usage:
+    python mock_base44.py --port 8044 --latency 0.05 --error-rate 0.1
+    API_BASE_URL=http://127.0.0.1:8044 python bot.py
+
+Both URL styles are accepted: /functions/<name> (bot.py) and /<name>
+(verify_setup.py, init_base44_config.py).
+
+Control endpoints:
+    GET  /_mock/stats     request counts, activity and batch totals
+    GET  /_mock/requests  recorded requests (?function=<name>&limit=<n>)
+    POST /_mock/faults    change latency/jitter/error_rate/max_rps at runtime
+    POST /_mock/config    replace the config served by getBotConfig
+    POST /_mock/reset     clear recorded requests and counters
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+DEFAULT_CONFIG = {
+    "active": True,
+    "affiliate_id": "mock_affiliate",
+    "message_templates": [
+        {
+            "name": "welcome_message",
+            "content": "Welcome {username}! Thanks for joining {server_name}! 🎉\n\nCheck out our latest offers:",
+            "has_buttons": True,
+            "button_labels": ["Get Started", "Learn More"],
+            "selected_link_name": "main_affiliate_link"
+        }
+    ],
+    "target_roles": [],
+    "affiliate_links": [
+        {
+            "name": "main_affiliate_link",
+            "url_template": "https://example.com/affiliate",
+            "enabled": True
+        }
+    ],
+    "settings": {
+        "rate_limit_delay": 1.0,
+        "max_dms_per_hour": 100,
+        "enable_ab_testing": False
+    }
+}
+
+class MockBase44:
+    """The mock server's state; usable from tests via start() and stop()"""
+
+    def __init__(self, config=None, latency=0.0, jitter=0.0, error_rate=0.0, max_rps=0.0,
+                 record_path=None, seed=None):
+        self.config = config if config is not None else json.loads(json.dumps(DEFAULT_CONFIG))
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_rps = max_rps
+        self.record_path = record_path
+        self.rng = random.Random(seed)
+        self.runner = None
+        self.reset()
+
+    def reset(self):
+        """Forget recorded requests and counters"""
+        self.requests = []
+        self.counts = {}
+        self.activities = 0
+        self.batches = 0
+        self.errors_injected = 0
+        self.throttled = 0
+        self.tokens = self.max_rps
+        self.tokens_updated = time.monotonic()
+        self.started_at = time.time()
+
+    def _throttle(self):
+        """Token bucket over all requests; returns seconds to retry after, or 0"""
+        if self.max_rps <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.max_rps, self.tokens + (now - self.tokens_updated) * self.max_rps)
+        self.tokens_updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.max_rps
+
+    def _record(self, function_name, method, payload, status, started):
+        entry = {
+            'function': function_name,
+            'method': method,
+            'status': status,
+            'received_at': started,
+            'duration': round(time.time() - started, 4),
+            'payload': payload
+        }
+        self.requests.append(entry)
+        self.counts[function_name] = self.counts.get(function_name, 0) + 1
+        if self.record_path:
+            with open(self.record_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def _respond(self, function_name, payload):
+        if function_name == 'getBotConfig':
+            return {'success': True, 'data': self.config}
+        if function_name == 'logBotActivity':
+            activities = payload.get('activities') if isinstance(payload, dict) else None
+            count = len(activities) if isinstance(activities, list) else 1
+            self.activities += count
+            self.batches += 1
+            return {'success': True, 'logged': count}
+        if function_name in ('updateBotStatus', 'trackLinkClick'):
+            return {'success': True}
+        return None
+
+    async def handle_function(self, request):
+        started = time.time()
+        function_name = request.match_info['function']
+        payload = None
+        if request.method == 'POST':
+            try:
+                payload = await request.json()
+            except Exception:
+                payload = await request.text()
+        else:
+            payload = dict(request.query)
+
+        status = 200
+        body = None
+        headers = {}
+        retry_after = self._throttle()
+        if retry_after:
+            self.throttled += 1
+            status = 429
+            headers['Retry-After'] = f'{retry_after:.3f}'
+            body = {'success': False, 'error': 'Too many requests'}
+        else:
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.rng.random() < self.error_rate:
+                self.errors_injected += 1
+                status = 500
+                body = {'success': False, 'error': 'Injected failure'}
+
+        if status == 200:
+            if function_name == 'trackLinkClick' and request.method == 'GET' and request.query.get('redirect'):
+                self._record(function_name, request.method, payload, 302, started)
+                raise web.HTTPFound(request.query['redirect'])
+            body = self._respond(function_name, payload)
+            if body is None:
+                status = 404
+                body = {'success': False, 'error': f'Unknown function {function_name}'}
+
+        self._record(function_name, request.method, payload, status, started)
+        return web.json_response(body, status=status, headers=headers)
+
+    def stats(self):
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        return {
+            'requests': len(self.requests),
+            'requests_per_second': round(len(self.requests) / elapsed, 2),
+            'by_function': self.counts,
+            'activities': self.activities,
+            'activity_batches': self.batches,
+            'average_batch_size': round(self.activities / self.batches, 2) if self.batches else 0,
+            'errors_injected': self.errors_injected,
+            'throttled': self.throttled
+        }
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def handle_requests(self, request):
+        function_name = request.query.get('function')
+        entries = [entry for entry in self.requests if not function_name or entry['function'] == function_name]
+        limit = int(request.query.get('limit', 0))
+        return web.json_response(entries[-limit:] if limit else entries)
+
+    async def handle_faults(self, request):
+        faults = await request.json()
+        for name in ('latency', 'jitter', 'error_rate', 'max_rps'):
+            if name in faults:
+                setattr(self, name, float(faults[name]))
+        self.tokens = self.max_rps
+        return web.json_response({'latency': self.latency, 'jitter': self.jitter,
+                                  'error_rate': self.error_rate, 'max_rps': self.max_rps})
+
+    async def handle_config(self, request):
+        self.config = await request.json()
+        return web.json_response({'success': True})
+
+    async def handle_reset(self, request):
+        self.reset()
+        return web.json_response({'success': True})
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/_mock/stats', self.handle_stats)
+        app.router.add_get('/_mock/requests', self.handle_requests)
+        app.router.add_post('/_mock/faults', self.handle_faults)
+        app.router.add_post('/_mock/config', self.handle_config)
+        app.router.add_post('/_mock/reset', self.handle_reset)
+        for prefix in ('/functions', ''):
+            app.router.add_route('POST', prefix + '/{function}', self.handle_function)
+            app.router.add_route('GET', prefix + '/{function}', self.handle_function)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8044):
+        """Start serving on the running event loop; returns the base URL"""
+        self.runner = web.AppRunner(self.create_app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        if port == 0:
+            port = self.runner.addresses[0][1]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+def main():
+    """Run the mock server until interrupted"""
+    parser = argparse.ArgumentParser(description='Local stand-in for the Base44 functions API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8044)
+    parser.add_argument('--config', help='JSON file with the bot config served by getBotConfig')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random latency, up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with HTTP 500')
+    parser.add_argument('--max-rps', type=float, default=0.0, help='requests/s before answering 429 (0 = no limit)')
+    parser.add_argument('--record', help='also append every request to this JSONL file')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+
+    mock = MockBase44(config, args.latency, args.jitter, args.error_rate, args.max_rps, args.record, args.seed)
+    print(f"🚀 Mock Base44 API on http://{args.host}:{args.port}")
+    print(f"   Latency: {args.latency}s (+{args.jitter}s jitter), error rate: {args.error_rate}, "
+          f"max rps: {args.max_rps or 'unlimited'}")
+    print(f"   Point the bot at it with: API_BASE_URL=http://{args.host}:{args.port}")
+    try:
+        web.run_app(mock.create_app(), host=args.host, port=args.port, print=None, access_log=None)
+    except KeyboardInterrupt:
+        pass
+    print(f"📊 {json.dumps(mock.stats())}")
+
+if __name__ == '__main__':
+    sys.exit(main())